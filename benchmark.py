@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+"""
+基准测试 - 在本机启动模拟视频站点，用无界面模式跑固定场景，不需要联网
+使用方法:
+    python benchmark.py                      # 跑全部场景，结果 JSON 输出到 stdout
+    python benchmark.py -o result.json       # 结果写入文件，方便不同版本对比
+    python benchmark.py tiny_clips --scale 0.1 -j 8
+
+模拟站点 (http://127.0.0.1:<端口>):
+    /file/<名称>.mp4?size=字节&latency=毫秒&rate=KB/s     渐进式文件，支持 Range
+    /hls/<名称>/index.m3u8?segments=N&seg_size=字节        HLS，N 个分片
+    /dash/<名称>/manifest.mpd?segments=N&seg_size=字节     DASH (2160p/1080p 视频 + 音频)
+    /page/<名称>.html?size=字节                            含 <video> 的网页，通用提取器解析
+    /feed/<名称>.xml?items=N                               混合 RSS 播放列表
+
+说明: 文件内容是合成数据，不是真实的音视频，所以子进程的 PATH 里会去掉 ffmpeg，
+测的是下载引擎本身 (提取、调度、分片、传输)，不含合并/转码。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import http.server
+
+# ==================== 配置 ====================
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "video.py")
+CHUNK = 64 * 1024
+
+# 场景: 名称 -> 说明、链接生成方式、下载参数
+SCENARIOS = {
+    "tiny_clips": {
+        "desc": "1000 个 64KB 小文件",
+        "count": 1000,
+        "args": ["-j", "8"],
+    },
+    "dash_4k": {
+        "desc": "一个 4K DASH 视频，600 个 256KB 分片",
+        "args": ["--type", "video_only", "--quality", "best"],
+    },
+    "hls_fragments": {
+        "desc": "一个 HLS 视频，400 个 128KB 分片",
+        "args": [],
+    },
+    "mixed_playlist": {
+        "desc": "RSS 播放列表: 渐进式/HLS/网页混合，50ms 延迟，部分限速",
+        "count": 30,
+        "args": ["-j", "4"],
+    },
+}
+
+# ==================== 颜色输出 ====================
+class Colors:
+    GREEN = '\033[92m'
+    YELLOW = '\033[93m'
+    RED = '\033[91m'
+    BLUE = '\033[94m'
+    END = '\033[0m'
+    BOLD = '\033[1m'
+
+def print_step(text):
+    print(f"\n{Colors.BLUE}▶{Colors.END} {Colors.BOLD}{text}{Colors.END}", file=sys.stderr)
+
+def print_success(text):
+    print(f"{Colors.GREEN}✓ {text}{Colors.END}", file=sys.stderr)
+
+def print_error(text):
+    print(f"{Colors.RED}✗ {text}{Colors.END}", file=sys.stderr)
+
+def print_warning(text):
+    print(f"{Colors.YELLOW}⚠ {text}{Colors.END}", file=sys.stderr)
+
+# ==================== 模拟站点 ====================
+class MockHost:
+    """本机模拟视频站点 - 内容按需生成，不占磁盘；统计实际发出的字节数"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+        host = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_HEAD(self):
+                self.handle_request(head=True)
+
+            def do_GET(self):
+                self.handle_request(head=False)
+
+            def handle_request(self, head):
+                parsed = urllib.parse.urlsplit(self.path)
+                query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()}
+                with host.lock:
+                    host.requests += 1
+                latency = int(query.get("latency", 0))
+                if latency:
+                    time.sleep(latency / 1000)
+                try:
+                    route = host.route(parsed.path, query)
+                except (ValueError, KeyError):
+                    route = None
+                if route is None:
+                    self.send_error(404)
+                    return
+                content_type, size, body = route
+                host.send(self, content_type, size, body, int(query.get("rate", 0)), head)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self, path, **query):
+        return f"{self.base}{path}" + (f"?{urllib.parse.urlencode(query)}" if query else "")
+
+    def route(self, path, query):
+        """-> (Content-Type, 大小, 文本内容或 None 表示合成二进制)"""
+        parts = path.strip("/").split("/")
+        kind = parts[0]
+        if kind == "file":
+            return "video/mp4", int(query.get("size", 1024 * 1024)), None
+        if kind == "hls":
+            if parts[-1] == "index.m3u8":
+                return "application/vnd.apple.mpegurl", None, self.m3u8(query)
+            return "video/mp2t", int(query.get("seg_size", 128 * 1024)), None
+        if kind == "dash":
+            if parts[-1] == "manifest.mpd":
+                return "application/dash+xml", None, self.mpd(query)
+            return "video/mp4", int(query.get("seg_size", 256 * 1024)), None
+        if kind == "page":
+            name = parts[-1].rsplit(".", 1)[0]
+            src = self.url(f"/file/{name}.mp4", size=query.get("size", 512 * 1024),
+                           **{k: v for k, v in query.items() if k in ("latency", "rate")})
+            return "text/html; charset=utf-8", None, (
+                f"<!DOCTYPE html><html><head><title>{name}</title>"
+                f'<meta property="og:title" content="{name}"></head><body>'
+                f'<video controls width="1280" height="720"><source src="{src}" type="video/mp4"></video>'
+                f"</body></html>")
+        if kind == "feed":
+            return "application/rss+xml", None, self.rss(parts[-1].rsplit(".", 1)[0], int(query.get("items", 10)))
+        return None
+
+    def m3u8(self, query):
+        segments = int(query.get("segments", 100))
+        seg_query = urllib.parse.urlencode({k: v for k, v in query.items() if k in ("seg_size", "latency", "rate")})
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", "#EXT-X-TARGETDURATION:2", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for i in range(segments):
+            lines += ["#EXTINF:2.000,", f"seg{i}.ts?{seg_query}"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def mpd(self, query):
+        segments = int(query.get("segments", 100))
+        seg_query = urllib.parse.urlencode({k: v for k, v in query.items() if k in ("seg_size", "latency", "rate")})
+        seg_query = seg_query.replace("&", "&amp;")
+        template = (f'<SegmentTemplate timescale="1" duration="2" startNumber="1" '
+                    f'initialization="$RepresentationID$/init.mp4?{seg_query}" '
+                    f'media="$RepresentationID$/$Number$.m4s?{seg_query}"/>')
+        return f"""<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" minBufferTime="PT2S"
+     mediaPresentationDuration="PT{segments * 2}S" profiles="urn:mpeg:dash:profile:isoff-live:2011">
+  <Period id="0" start="PT0S">
+    <AdaptationSet mimeType="video/mp4" contentType="video" segmentAlignment="true">
+      {template}
+      <Representation id="v2160" codecs="avc1.640033" width="3840" height="2160" frameRate="30" bandwidth="20000000"/>
+      <Representation id="v1080" codecs="avc1.640028" width="1920" height="1080" frameRate="30" bandwidth="5000000"/>
+    </AdaptationSet>
+    <AdaptationSet mimeType="audio/mp4" contentType="audio" lang="en">
+      {template}
+      <Representation id="a128" codecs="mp4a.40.2" audioSamplingRate="48000" bandwidth="128000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+    def rss(self, name, items):
+        """混合播放列表: 渐进式文件 / HLS / 网页轮流，每三个里有一个限速"""
+        entries = []
+        for i in range(items):
+            extra = {"latency": 50}
+            if i % 3 == 2:
+                extra["rate"] = 2048
+            kind = i % 3
+            if kind == 0:
+                url = self.url(f"/file/{name}-{i}.mp4", size=1024 * 1024, **extra)
+            elif kind == 1:
+                url = self.url(f"/hls/{name}-{i}/index.m3u8", segments=20, seg_size=64 * 1024, **extra)
+            else:
+                url = self.url(f"/page/{name}-{i}.html", size=512 * 1024, **extra)
+            url = url.replace("&", "&amp;")
+            entries.append(f"<item><title>{name} {i}</title><link>{url}</link>"
+                           f'<enclosure url="{url}" type="video/mp4"/></item>')
+        return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                f"<title>{name}</title><link>{self.base}/</link>{''.join(entries)}</channel></rss>")
+
+    def send(self, handler, content_type, size, body, rate_kb, head):
+        if body is not None:
+            data = body.encode("utf-8")
+            size = len(data)
+        start, end = 0, size - 1
+        status = 200
+        range_header = handler.headers.get("Range")
+        if body is None and range_header and range_header.startswith("bytes="):
+            first, _, last = range_header[6:].split(",")[0].partition("-")
+            start = int(first) if first else max(0, size - int(last))
+            end = min(int(last), size - 1) if first and last else size - 1
+            if start >= size:
+                handler.send_response(416)
+                handler.send_header("Content-Range", f"bytes */{size}")
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+                return
+            status = 206
+        length = end - start + 1
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(length))
+        handler.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            handler.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        handler.end_headers()
+        if head:
+            return
+        if body is not None:
+            handler.wfile.write(data)
+            self.count(len(data))
+            return
+        # 合成数据，限速时按块节流
+        block = bytes(CHUNK)
+        began = time.monotonic()
+        sent = 0
+        try:
+            while sent < length:
+                n = min(CHUNK, length - sent)
+                handler.wfile.write(block[:n])
+                sent += n
+                self.count(n)
+                if rate_kb:
+                    ahead = sent / (rate_kb * 1024) - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def count(self, n):
+        with self.lock:
+            self.bytes_sent += n
+
+    def snapshot(self):
+        with self.lock:
+            return self.bytes_sent, self.requests
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+# ==================== 场景 ====================
+def scenario_urls(host, name, scale):
+    if name == "tiny_clips":
+        count = max(1, int(SCENARIOS[name]["count"] * scale))
+        return [host.url(f"/file/clip{i}.mp4", size=64 * 1024) for i in range(count)]
+    if name == "dash_4k":
+        return [host.url("/dash/uhd/manifest.mpd", segments=max(1, int(600 * scale)), seg_size=256 * 1024)]
+    if name == "hls_fragments":
+        return [host.url("/hls/long/index.m3u8", segments=max(1, int(400 * scale)), seg_size=128 * 1024)]
+    if name == "mixed_playlist":
+        count = max(3, int(SCENARIOS[name]["count"] * scale))
+        return [host.url("/feed/mixed.xml", items=count)]
+    raise ValueError(name)
+
+
+def child_env(home):
+    """子进程环境: 独立的配置目录 (冷缓存、空任务库)，PATH 去掉 ffmpeg"""
+    env = dict(os.environ)
+    env["HOME"] = env["USERPROFILE"] = home
+    paths = env.get("PATH", "").split(os.pathsep)
+    env["PATH"] = os.pathsep.join(p for p in paths if not shutil.which("ffmpeg", path=p))
+    return env
+
+
+def run_scenario(host, name, scale, extra_args):
+    work = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    try:
+        home = os.path.join(work, "home")
+        os.makedirs(os.path.join(home, ".video_downloader"))
+        with open(os.path.join(home, ".video_downloader", "config.json"), "w", encoding="utf-8") as f:
+            json.dump({"ffmpeg_path": "", "proxy": "", "use_archive": False}, f)
+        url_file = os.path.join(work, "urls.txt")
+        with open(url_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(scenario_urls(host, name, scale)) + "\n")
+
+        cmd = [sys.executable, MAIN_SCRIPT, "--headless", url_file, "-o", os.path.join(work, "out"),
+               "--no-cookies", "--no-proxy", *SCENARIOS[name]["args"], *extra_args]
+        bytes_before, requests_before = host.snapshot()
+        log_path = os.path.join(work, "events.jsonl")
+        began = time.perf_counter()
+        with open(log_path, "w", encoding="utf-8") as log:
+            proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.DEVNULL, env=child_env(home))
+            usage = None
+            if hasattr(os, "wait4"):
+                _, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+            else:
+                proc.wait()
+        wall = time.perf_counter() - began
+        bytes_after, requests_after = host.snapshot()
+
+        done = {}
+        with open(log_path, encoding="utf-8") as log:
+            for line in log:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get("event") == "done":
+                    done = event
+        served = bytes_after - bytes_before
+        result = {
+            "name": name,
+            "description": SCENARIOS[name]["desc"],
+            "scale": scale,
+            "exit_code": proc.returncode,
+            "wall_seconds": round(wall, 3),
+            "bytes_served": served,
+            "requests": requests_after - requests_before,
+            "throughput_bytes_per_sec": round(served / wall) if wall else 0,
+            "tasks": done.get("total"),
+            "completed": done.get("completed"),
+            "failed": done.get("failed"),
+            "extracts": done.get("extracts"),
+            "phases": done.get("phases"),
+            "cpu_user_seconds": None,
+            "cpu_system_seconds": None,
+            "peak_rss_kb": None,
+        }
+        if usage:
+            # Linux 的 ru_maxrss 单位是 KB，macOS 是字节
+            rss = usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+            result.update(cpu_user_seconds=round(usage.ru_utime, 3), cpu_system_seconds=round(usage.ru_stime, 3),
+                          peak_rss_kb=rss)
+        return result
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+# ==================== 主程序 ====================
+def yt_dlp_version():
+    try:
+        result = subprocess.run([sys.executable, "-c", "import yt_dlp; print(yt_dlp.version.__version__)"],
+                                capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载引擎基准测试 (本机模拟站点，不联网)")
+    parser.add_argument("scenarios", nargs="*", help=f"要跑的场景，默认全部: {', '.join(SCENARIOS)}")
+    parser.add_argument("-o", "--output", help="结果 JSON 写入文件 (默认 stdout)")
+    parser.add_argument("--scale", type=float, default=1.0, help="按比例缩小场景规模，如 0.1")
+    args, extra_args = parser.parse_known_args()  # 其余参数原样传给 video.py --headless
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error(f"未知场景: {name}")
+
+    host = MockHost()
+    print_step(f"模拟站点: {host.base}")
+    results = []
+    try:
+        for name in names:
+            print_step(f"{name} - {SCENARIOS[name]['desc']}")
+            result = run_scenario(host, name, args.scale, extra_args)
+            results.append(result)
+            line = (f"{result['wall_seconds']:.2f}s | {result['bytes_served'] / 1024 / 1024:.1f}MB | "
+                    f"{result['throughput_bytes_per_sec'] / 1024 / 1024:.1f}MB/s | "
+                    f"完成 {result['completed']}/{result['tasks']}")
+            if result["peak_rss_kb"] is not None:
+                line += (f" | CPU {result['cpu_user_seconds'] + result['cpu_system_seconds']:.2f}s"
+                         f" | 峰值内存 {result['peak_rss_kb'] / 1024:.0f}MB")
+            if result["exit_code"] == 0:
+                print_success(line)
+            else:
+                print_error(f"{line} (退出码 {result['exit_code']})")
+    except KeyboardInterrupt:
+        print_warning("已取消")
+        return 130
+    finally:
+        host.close()
+
+    report = {
+        "time": round(time.time(), 3),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "yt_dlp": yt_dlp_version(),
+        "args": extra_args,
+        "scenarios": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print_success(f"结果已写入 {args.output}")
+    else:
+        print(text)
+    return 0 if all(r["exit_code"] == 0 for r in results) else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
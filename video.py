@@ -1,21 +1,135 @@
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, scrolledtext
 import threading
 import os
 import sys
 import subprocess
 import re
 import json
+import sqlite3
 import ctypes
-from concurrent.futures import ThreadPoolExecutor
+import argparse
+import signal
+import shutil
+import hashlib
+import inspect
+import mmap
+import heapq
+import itertools
+import random
+import email.utils
+import logging.handlers
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import time
+import importlib.util
 
-# 检查并安装 yt-dlp
-try:
-    import yt_dlp
-except ImportError:
-    subprocess.check_call([sys.executable, "-m", "pip", "install", "yt-dlp"])
-    import yt_dlp
+
+class StartupProfile:
+    """启动耗时记录 - --profile-startup 时把各阶段耗时和 yt-dlp 的导入耗时明细打印到 stderr"""
+    
+    def __init__(self):
+        self.enabled = False
+        self.t0 = time.perf_counter()
+        self.last = self.t0
+        self.phases = []  # (阶段, 耗时, 距启动)
+        self.lock = threading.Lock()
+    
+    def mark(self, name, seconds=None):
+        """记录一个阶段；不给 seconds 时取距上一个阶段的时间"""
+        with self.lock:
+            now = time.perf_counter()
+            self.phases.append((name, now - self.last if seconds is None else seconds, now - self.t0))
+            if seconds is None:
+                self.last = now
+    
+    def report(self):
+        if not self.enabled:
+            return
+        out = sys.stderr
+        print("⏱️ 启动耗时 (ms):", file=out)
+        for name, seconds, since in self.phases:
+            print(f"  {seconds * 1000:8.1f}  (+{since * 1000:7.1f})  {name}", file=out)
+        extractors = sum(1 for name in sys.modules if name.startswith('yt_dlp.extractor.'))
+        lazy = importlib.util.find_spec('yt_dlp.extractor.lazy_extractors') is not None
+        print(f"  已加载提取器模块: {extractors} 个 | 提取器懒加载: {'✓' if lazy else '✗ (没有 lazy_extractors)'}",
+              file=out)
+        print("⏱️ import yt_dlp 明细 (自身耗时 ms, 新进程内测量):", file=out)
+        for group, micros in self.import_breakdown():
+            print(f"  {micros / 1000:8.1f}  {group}", file=out)
+    
+    @staticmethod
+    def import_breakdown(top=12):
+        """用 -X importtime 在新进程里导入 yt_dlp，按包汇总各模块自身耗时"""
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import yt_dlp'],
+                                capture_output=True, text=True, errors='replace')
+        totals = {}
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+\d+ \|\s+(\S+)', line)
+            if not match:
+                continue
+            parts = match.group(2).split('.')
+            group = '.'.join(parts[:2]) if parts[0] == 'yt_dlp' else parts[0]
+            totals[group] = totals.get(group, 0) + int(match.group(1))
+        return sorted(totals.items(), key=lambda item: -item[1])[:top]
+
+
+startup = StartupProfile()
+
+
+class LazyModule:
+    """第一次访问属性时才导入的模块 - yt-dlp 导入要加载大量模块，放到窗口显示之后 (或真正用到时) 再做"""
+    
+    def __init__(self, name, package=None):
+        self._name = name
+        self._package = package or name
+        self._module = None
+        self._lock = threading.Lock()
+    
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.perf_counter()
+                    try:
+                        module = importlib.import_module(self._name)
+                    except ImportError:
+                        # 检查并安装 yt-dlp
+                        subprocess.check_call([sys.executable, "-m", "pip", "install", self._package])
+                        module = importlib.import_module(self._name)
+                    startup.mark(f"import {self._name}", time.perf_counter() - start)
+                    self._module = module
+        return self._module
+    
+    @property
+    def loaded(self):
+        return self._module is not None
+    
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+yt_dlp = LazyModule("yt_dlp", "yt-dlp")
+
+
+def load_tkinter():
+    """导入 tkinter - 只在 GUI 模式调用，无头模式不需要显示环境"""
+    global tk, ttk, filedialog, messagebox, scrolledtext
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox, scrolledtext
+    startup.mark("import tkinter")
+
+
+def preload_yt_dlp(on_loaded=None):
+    """后台线程导入 yt-dlp，窗口先响应；下载前还没加载完时第一次使用会等它"""
+    def load():
+        try:
+            yt_dlp.load()
+        except Exception as e:
+            print(f"加载 yt-dlp 失败: {e}")
+            return
+        if on_loaded:
+            on_loaded()
+    threading.Thread(target=load, daemon=True).start()
 
 
 def is_admin():
@@ -38,6 +152,24 @@ def fix_proxy_protocol(proxy):
     return proxy
 
 
+def url_domain(url):
+    """链接所属站点 (去掉 www.)"""
+    host = urllib.parse.urlparse(url).hostname or ""
+    return host[4:] if host.startswith('www.') else host
+
+
+def parse_urls(text):
+    """从文本中解析链接 (一行一个)"""
+    urls = []
+    for line in text.strip().split('\n'):
+        line = line.strip()
+        if line and (line.startswith('http') or line.startswith('www')):
+            if line.startswith('www'):
+                line = 'https://' + line
+            urls.append(line)
+    return urls
+
+
 class ConfigManager:
     """配置管理器"""
     _instance = None
@@ -64,6 +196,25 @@ class ConfigManager:
             "max_concurrent": 3,
             "thread_count": 8,
             "prefer_free_formats": False,  # 新增：是否优先免费格式
+            "ui_refresh_hz": 10,  # 任务列表刷新频率
+            "use_archive": False,  # 下载存档：跳过下载过的视频
+            "probe_workers": 8,  # 获取信息的并发数
+            "probe_per_domain": 3,  # 获取信息时每个站点的并发上限
+            "info_cache_ttl": 1800,  # 视频信息缓存有效期 (秒)，格式链接更早过期时以其为准
+            "info_cache_mb": 256,  # 视频信息磁盘缓存上限 (MB)
+            "bandwidth_limit_mb": 0,  # 所有下载共享的总带宽上限 (MB/s)，0 为不限
+            "bandwidth_fair": True,  # 限速时按任务权重平分带宽
+            "adaptive_concurrency": False,  # 按站点自动调整同时下载数和分片线程数
+            "max_concurrent_limit": 10,  # 自适应时同时下载数上限
+            "thread_count_limit": 32,  # 自适应时分片线程数上限
+            "shortest_first": False,  # 同优先级时按缓存信息里的文件大小，小的先下
+            "postprocess_workers": 0,  # 合并/转码的并发数，0 为 CPU 核数
+            "max_retries": 3,  # 临时错误的自动重试次数
+            "retry_base_delay": 2,  # 首次重试等待秒数，之后按指数增长
+            "log_max_lines": 5000,  # 日志面板最多保留的行数，完整日志见配置目录下的 logs
+            "log_file_mb": 5,  # 单个日志文件大小，超过后轮转
+            "log_backups": 5,  # 保留的旧日志文件数
+            "trace_file": "",  # 每次下载尝试的阶段耗时写成 JSONL 跟踪文件，空为不记录
         }
         
         try:
@@ -115,23 +266,68 @@ class ConfigManager:
 
 
 class FFmpegManager:
-    """FFmpeg 管理器"""
+    """FFmpeg 管理器
+    
+    检测结果 (路径、版本、编码器/封装格式) 缓存在配置目录的 ffmpeg_cache.json，
+    按可执行文件的修改时间和大小判断是否失效，命中时启动不需要运行 ffmpeg。
+    """
     
-    def __init__(self, config_manager):
+    def __init__(self, config_manager, background=False):
+        """background=True 时只读缓存，校验/检测放到后台线程，结果有变化时 take_changed() 返回 True"""
         self.config = config_manager
+        self.cache_file = os.path.join(config_manager.config_dir, "ffmpeg_cache.json")
+        self.changed = False  # 后台校验后结果有变化，等界面定时器取走
         self.ffmpeg_path = None
         self.ffprobe_path = None
         self.is_available = False
-        self.detect_ffmpeg()
+        self.version = None
+        self.encoders = set()
+        self.muxers = set()
+        if background:
+            self.load_cache()
+            threading.Thread(target=self.revalidate, daemon=True).start()
+        else:
+            self.detect_ffmpeg()
         
-    def detect_ffmpeg(self):
+    def detect_ffmpeg(self, use_cache=True):
+        if use_cache and self.load_cache():
+            return True
         custom_path = self.config.get("ffmpeg_path", "")
         if custom_path and self.validate_ffmpeg_path(custom_path):
-            return True
-        if self.check_system_ffmpeg():
-            return True
-        self.is_available = False
-        return False
+            found = True
+        else:
+            found = self.check_system_ffmpeg()
+        if found:
+            self.probe_capabilities()
+            self.save_cache()
+        else:
+            self.is_available = False
+            self.ffmpeg_path = self.ffprobe_path = self.version = None
+            self.encoders, self.muxers = set(), set()
+        return found
+    
+    def revalidate(self):
+        """后台重新检测 (不用缓存)，结果和当前不同时标记 changed (后台线程不碰界面)"""
+        before = (self.ffmpeg_path, self.is_available, self.version)
+        try:
+            self.detect_ffmpeg(use_cache=False)
+        except Exception as e:
+            print(f"检测 FFmpeg 失败: {e}")
+            return
+        if (self.ffmpeg_path, self.is_available, self.version) != before:
+            self.changed = True
+    
+    def take_changed(self):
+        """上次调用以来后台校验是否改变了检测结果"""
+        changed, self.changed = self.changed, False
+        return changed
+    
+    def _run(self, *args):
+        kwargs = {}
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+        return subprocess.run([self.ffmpeg_path or "ffmpeg", *args], capture_output=True, text=True,
+                              errors='replace', **kwargs)
         
     def check_system_ffmpeg(self):
         try:
@@ -171,6 +367,86 @@ class FFmpegManager:
             return True
         except (subprocess.CalledProcessError, FileNotFoundError, OSError):
             return False
+    
+    def probe_capabilities(self):
+        """读取版本和支持的编码器、封装格式"""
+        try:
+            self.version = self._run('-version').stdout.split('\n')[0] or "未知版本"
+            self.encoders = self._parse_list(self._run('-hide_banner', '-encoders').stdout,
+                                             r'^\s*[VAS][\w.]{5}\s+(\w[\w,-]*)')
+            self.muxers = self._parse_list(self._run('-hide_banner', '-muxers').stdout,
+                                           r'^\s*[D ]E[d ]?\s+(\w[\w,-]*)')
+        except OSError:
+            self.version = "未知版本"
+    
+    @staticmethod
+    def _parse_list(text, pattern):
+        names = set()
+        for line in text.splitlines():
+            match = re.match(pattern, line)
+            if match:
+                names.update(match.group(1).split(','))
+        return names
+    
+    def has_encoder(self, name):
+        # 没探测到列表时不做判断
+        return not self.encoders or name in self.encoders
+    
+    def missing_encoders(self, audio_outputs):
+        """音频输出中当前 ffmpeg 没有编译进去的编码器"""
+        encoders = {AudioTranscoder.ENCODERS[fmt][0] for fmt, _ in audio_outputs or []}
+        return sorted(name for name in encoders if not self.has_encoder(name))
+    
+    def _binary_stat(self):
+        """可执行文件的 (路径, 修改时间, 大小)，作为缓存的失效依据"""
+        path = self.ffmpeg_path
+        if path == "ffmpeg":
+            path = shutil.which("ffmpeg")
+        if not path:
+            return None
+        st = os.stat(path)
+        return [os.path.realpath(path), st.st_mtime, st.st_size]
+    
+    def load_cache(self):
+        """缓存有效时直接采用，返回是否命中"""
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get("config_path") != self.config.get("ffmpeg_path", ""):
+                return False  # 设置里换了路径
+            self.ffmpeg_path = cache["ffmpeg_path"]
+            if self._binary_stat() != cache["stat"]:
+                self.ffmpeg_path = None
+                return False  # 可执行文件被替换或已删除
+        except (OSError, ValueError, KeyError, TypeError):
+            self.ffmpeg_path = None
+            return False
+        self.ffprobe_path = cache.get("ffprobe_path")
+        if self.ffprobe_path and self.ffprobe_path != "ffprobe" and not os.path.exists(self.ffprobe_path):
+            self.ffprobe_path = None
+        self.version = cache.get("version")
+        self.encoders = set(cache.get("encoders") or [])
+        self.muxers = set(cache.get("muxers") or [])
+        self.is_available = True
+        return True
+    
+    def save_cache(self):
+        try:
+            cache = {
+                "config_path": self.config.get("ffmpeg_path", ""),
+                "ffmpeg_path": self.ffmpeg_path,
+                "ffprobe_path": self.ffprobe_path,
+                "stat": self._binary_stat(),
+                "version": self.version,
+                "encoders": sorted(self.encoders),
+                "muxers": sorted(self.muxers),
+            }
+            tmp = self.cache_file + ".tmp"
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(cache, f, ensure_ascii=False)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            print(f"保存 FFmpeg 缓存失败: {e}")
             
     def get_ffmpeg_location(self):
         if self.ffmpeg_path and self.ffmpeg_path != "ffmpeg":
@@ -180,143 +456,2694 @@ class FFmpegManager:
     def get_version(self):
         if not self.is_available:
             return None
+        if self.version is None:
+            self.probe_capabilities()
+        return self.version
+
+
+class JobStore:
+    """持久化任务库 (SQLite) - 记录每个链接的状态，重启后只继续未完成的任务
+    
+    写入先合并到内存，攒够 batch_size 条或超过 commit_interval 秒再统一提交。
+    """
+    PENDING = "pending"
+    RUNNING = "downloading"
+    DONE = "done"
+    FAILED = "failed"
+    
+    def __init__(self, path, batch_size=200, commit_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.commit_interval = commit_interval
+        self.lock = threading.Lock()
+        self.pending = {}  # url -> 待写入字段 (同一链接的多次更新合并为一次)
+        self.last_commit = time.time()
+        
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                url TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                title TEXT,
+                resolution TEXT,
+                metadata TEXT,
+                output_path TEXT,
+                error TEXT,
+                updated_at REAL,
+                parent TEXT
+            )""")
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(jobs)")}
+        if "parent" not in columns:  # 旧版本建的库
+            self.conn.execute("ALTER TABLE jobs ADD COLUMN parent TEXT")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_parent ON jobs(parent)")
+        self.conn.commit()
+    
+    def add(self, urls, parent=None):
+        """登记新链接 (已存在的保持原状态)，parent 为展开出这些链接的播放列表"""
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO jobs (url, status, updated_at, parent) VALUES (?, ?, ?, ?)",
+                [(url, self.PENDING, now, parent) for url in urls])
+            if parent:
+                self.conn.executemany("UPDATE jobs SET parent = ? WHERE url = ? AND parent IS NULL",
+                                      [(parent, url) for url in urls])
+            self._commit()
+    
+    def update(self, url, **fields):
+        with self.lock:
+            self.pending.setdefault(url, {}).update(fields)
+            if (len(self.pending) >= self.batch_size
+                    or time.time() - self.last_commit >= self.commit_interval):
+                self._commit()
+    
+    def flush(self):
+        with self.lock:
+            self._commit()
+    
+    def _commit(self):
+        now = time.time()
+        for url, fields in self.pending.items():
+            columns = ', '.join(f"{key} = ?" for key in fields)
+            self.conn.execute(f"UPDATE jobs SET {columns}, updated_at = ? WHERE url = ?",
+                              (*fields.values(), now, url))
+        self.pending = {}
+        self.conn.commit()
+        self.last_commit = now
+    
+    def lookup(self, urls):
+        """按主键批量查询，返回 {url: 记录字典}"""
+        jobs = {}
+        urls = list(dict.fromkeys(urls))
+        with self.lock:
+            self._commit()
+            for i in range(0, len(urls), 500):
+                chunk = urls[i:i + 500]
+                rows = self.conn.execute(
+                    "SELECT url, status, title, resolution, output_path, error FROM jobs "
+                    f"WHERE url IN ({', '.join('?' * len(chunk))})", chunk)
+                for url, status, title, resolution, output_path, error in rows:
+                    jobs[url] = {"status": status, "title": title, "resolution": resolution,
+                                 "output_path": output_path, "error": error}
+        return jobs
+    
+    def unfinished(self):
+        """上次没有完成的链接 (等待中 / 下载中被中断)"""
+        with self.lock:
+            self._commit()
+            rows = self.conn.execute("SELECT url FROM jobs WHERE status IN (?, ?) ORDER BY rowid",
+                                     (self.PENDING, self.RUNNING))
+            return [row[0] for row in rows]
+    
+    def enqueued_children(self, parent):
+        """播放列表之前展开过、还没完成的视频 (它们作为未完成任务自行继续，不必再次展开)"""
+        with self.lock:
+            self._commit()
+            rows = self.conn.execute("SELECT url FROM jobs WHERE parent = ? AND status IN (?, ?)",
+                                     (parent, self.PENDING, self.RUNNING))
+            return {row[0] for row in rows}
+    
+    def close(self):
+        with self.lock:
+            self._commit()
+            self.conn.close()
+
+
+def open_job_store(config):
+    """打开配置目录下的任务库，失败时返回 None (不影响正常下载)"""
+    try:
+        return JobStore(os.path.join(config.config_dir, "jobs.db"))
+    except Exception as e:
+        print(f"打开任务库失败: {e}")
+        return None
+
+
+class DownloadArchive:
+    """下载存档 - 按 "提取器 视频ID" 记录已下载的视频
+    
+    键格式与 yt-dlp 的 download_archive 相同，存在 SQLite 主键表里，成员判断走索引。
+    对象本身可以直接作为 yt-dlp 的 download_archive 参数 (支持 in / add)。
+    """
+    _extractors = None
+    
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS archive (key TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.commit()
+    
+    def __contains__(self, key):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM archive WHERE key = ?", (key,)).fetchone() is not None
+    
+    def __bool__(self):
+        # yt-dlp 用 `if not self.archive` 判断是否启用存档，避免触发 COUNT(*)
+        return True
+    
+    def add(self, key):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO archive (key) VALUES (?)", (key,))
+            self.conn.commit()
+    
+    @classmethod
+    def key_for_url(cls, url):
+        """不联网，直接用提取器的链接规则算出存档键 (识别不了返回 None)"""
+        if cls._extractors is None:
+            cls._extractors = [ie for ie in yt_dlp.extractor.gen_extractor_classes() if ie.ie_key() != 'Generic']
+        for ie in cls._extractors:
+            if ie.suitable(url):
+                video_id = ie.get_temp_id(url)
+                return yt_dlp.utils.make_archive_id(ie, video_id) if video_id else None
+        return None
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_download_archive(config):
+    """打开配置目录下的下载存档，失败时返回 None"""
+    try:
+        return DownloadArchive(os.path.join(config.config_dir, "archive.db"))
+    except Exception as e:
+        print(f"打开下载存档失败: {e}")
+        return None
+
+
+class InfoCache:
+    """视频信息缓存 - 内存 LRU + 磁盘，键为规范化后的链接
+    
+    有效期取 ttl 与格式链接里 expire= 的较小值 (如 googlevideo 的签名链接)，
+    内存和磁盘都按字节数淘汰最久未用的条目。
+    """
+    MEMORY_BYTES = 64 * 1024 * 1024
+    EXPIRE_RE = re.compile(r'[?&/]expire[=/](\d+)')
+    TRACKING_PARAMS = ('si', 'feature', 'fbclid', 'spm_id_from', 'vd_source')
+    
+    def __init__(self, cache_dir, ttl=1800, disk_bytes=256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.disk_bytes = disk_bytes
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()  # key -> (过期时间, json 文本)
+        self.memory_size = 0
+        self.disk = OrderedDict()  # 文件名 -> 大小，按写入时间排序
+        self.disk_size = 0
+        self.hits = 0
+        self.misses = 0
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = sorted((e for e in os.scandir(cache_dir) if e.name.endswith('.json')),
+                         key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            size = entry.stat().st_size
+            self.disk[entry.name] = size
+            self.disk_size += size
+    
+    @classmethod
+    def normalize_url(cls, url):
+        """去掉锚点和跟踪参数，统一大小写和参数顺序"""
+        parts = urllib.parse.urlsplit(url.strip())
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+                 if not k.startswith('utm_') and k not in cls.TRACKING_PARAMS]
+        return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path,
+                                        urllib.parse.urlencode(sorted(query)), ''))
+    
+    def _filename(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json'
+    
+    def expires_at(self, info):
+        expires = time.time() + self.ttl
+        for f in info.get('formats') or []:
+            for field in ('url', 'manifest_url', 'fragment_base_url'):
+                match = self.EXPIRE_RE.search(f.get(field) or '')
+                if match:
+                    # 提前一分钟失效，留出开始下载的时间
+                    expires = min(expires, int(match.group(1)) - 60)
+        return expires
+    
+    def get(self, url, count=True):
+        """命中返回信息字典 (每次返回新副本)，否则返回 None；count=False 时不计入命中统计"""
+        key = self.normalize_url(url)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[0] > now:
+                self.memory.move_to_end(key)
+                self.hits += count
+                return json.loads(entry[1])
+        
+        filename = self._filename(key)
         try:
-            ffmpeg_cmd = self.ffmpeg_path or "ffmpeg"
-            kwargs = {}
-            if sys.platform == 'win32':
-                kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
-            result = subprocess.run([ffmpeg_cmd, '-version'], capture_output=True, text=True, **kwargs)
-            if result.stdout:
-                return result.stdout.split('\n')[0]
-        except:
+            with open(os.path.join(self.cache_dir, filename), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = None
+        with self.lock:
+            if data and data.get('url') == key and data['expires'] > now:
+                self._remember(key, data['expires'], json.dumps(data['info'], ensure_ascii=False))
+                self.hits += count
+                return data['info']
+            self.misses += count
+        return None
+    
+    def put(self, url, info):
+        """缓存单个视频的信息 (播放列表不缓存)，info 应已经过 sanitize_info 处理"""
+        if not info or info.get('_type', 'video') != 'video':
+            return
+        expires = self.expires_at(info)
+        if expires <= time.time():
+            return
+        key = self.normalize_url(url)
+        text = json.dumps(info, ensure_ascii=False)
+        filename = self._filename(key)
+        path = os.path.join(self.cache_dir, filename)
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'url': key, 'expires': expires, 'info': info}, f, ensure_ascii=False)
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        with self.lock:
+            self._remember(key, expires, text)
+            if size is not None:
+                self.disk_size += size - self.disk.pop(filename, 0)
+                self.disk[filename] = size
+                self._evict_disk()
+    
+    def _remember(self, key, expires, text):
+        old = self.memory.pop(key, None)
+        if old:
+            self.memory_size -= len(old[1])
+        self.memory[key] = (expires, text)
+        self.memory_size += len(text)
+        while self.memory_size > self.MEMORY_BYTES and len(self.memory) > 1:
+            _, (_, evicted) = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+    
+    def _evict_disk(self):
+        while self.disk_size > self.disk_bytes and len(self.disk) > 1:
+            filename, size = self.disk.popitem(last=False)
+            self.disk_size -= size
+            try:
+                os.remove(os.path.join(self.cache_dir, filename))
+            except OSError:
+                pass
+    
+    def discard(self, url):
+        """删掉一个链接的缓存 (如格式链接已过期)"""
+        key = self.normalize_url(url)
+        filename = self._filename(key)
+        with self.lock:
+            entry = self.memory.pop(key, None)
+            if entry:
+                self.memory_size -= len(entry[1])
+            size = self.disk.pop(filename, None)
+            if size is not None:
+                self.disk_size -= size
+        try:
+            os.remove(os.path.join(self.cache_dir, filename))
+        except OSError:
             pass
-        return "未知版本"
+    
+    def stats_text(self):
+        return (f"命中 {self.hits} / 未命中 {self.misses} | "
+                f"内存 {self.memory_size / 1024 / 1024:.1f}MB | 磁盘 {self.disk_size / 1024 / 1024:.1f}MB")
+
+
+def open_info_cache(config):
+    """打开配置目录下的视频信息缓存，失败时返回 None"""
+    try:
+        return InfoCache(os.path.join(config.config_dir, "info_cache"),
+                         ttl=config.get("info_cache_ttl", 1800),
+                         disk_bytes=config.get("info_cache_mb", 256) * 1024 * 1024)
+    except Exception as e:
+        print(f"打开信息缓存失败: {e}")
+        return None
 
 
 class DownloadTask:
-    """下载任务"""
+    """下载任务 - 进度和速度保存为数值，显示时再格式化"""
+    __slots__ = ('url', 'title', 'status', 'progress', 'downloaded_bytes', 'total_bytes', 'speed', 'eta',
+                 'error', 'completed', 'cancelled', 'resolution', 'extract_count', 'output_path', 'skipped',
+                 'parent', 'weight', 'bytes_done', 'transfer_time', 'attempts', 'error_class', 'paused',
+                 'stage', 'queued', 'queue_seq', 'priority', 'size', 'plan', 'thread', 'retry_timer',
+                 'fragments', 'phase', 'phase_started', 'phase_times', 'batch_share')
+    SPEED_ALPHA = 0.3  # 速度 EWMA 平滑系数，越大越跟手
+    
     def __init__(self, url, title=None):
         self.url = url
         self.title = title or url[:50]
         self.status = "等待中"
-        self.progress = 0
-        self.speed = ""
-        self.eta = ""
+        self.progress = 0.0  # 百分比
+        self.downloaded_bytes = 0  # 本次尝试已下载字节数 (含已完成的文件)
+        self.total_bytes = None  # 预计总字节数，未知为 None
+        self.speed = 0.0  # 平滑后的速度 (字节/秒)
+        self.eta = None  # 预计剩余秒数，未知为 None
         self.error = None
         self.completed = False
         self.cancelled = False
         self.resolution = ""  # 新增：实际下载分辨率
+        self.extract_count = 0  # 信息提取次数 (正常应为 1)
+        self.output_path = None
+        self.skipped = False  # 命中下载存档，未实际下载
+        self.parent = None  # 由播放列表展开而来时指向播放列表任务
+        self.weight = 1.0  # 限速时分到的带宽权重
+        self.bytes_done = 0  # 已下载完的文件字节数
+        self.transfer_time = 0.0  # 传输耗时 (秒)，不含提取和后处理
+        self.attempts = 0  # 已重试次数
+        self.error_class = None  # 最近一次错误的分类 (见 RetryPolicy)
+        self.paused = False
+        self.stage = None  # 当前占用的流水线阶段 (见 PipelineStages)
+        self.queued = False  # 已提交 (排队或下载中)
+        self.queue_seq = None  # 在调度队列中的序号，开始执行或撤下后为 None
+        self.priority = 0  # 数值越大越先下载
+        self.size = None  # 预估文件大小 (字节)，来自缓存的视频信息
+        self.plan = None  # 封装方式 (见 PLAN_LABELS)
+        self.thread = None  # 正在执行该任务的线程 id
+        self.retry_timer = None
+        self.fragments = 0  # 已下载完的分片数 (非分片下载为 0)
+        self.phase = None  # 当前计时的阶段 (见 Metrics.PHASES)
+        self.phase_started = 0.0
+        self.phase_times = {}  # 本次尝试各阶段累计耗时 (秒)
+        self.batch_share = (0, 0, 0, 0.0)  # 上次计入整批统计的 (已下载, 总量, 未知大小, 速度)
+
+
+ANSI_ESCAPE = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+
+
+class LogBuffer:
+    """日志缓冲 - 任意线程都可以写，界面定时批量取出显示
+    
+    待显示的行最多保留 max_lines 行 (积压时丢掉最旧的)，完整日志按大小轮转写到 log_dir。
+    """
+    
+    def __init__(self, max_lines=5000, log_dir=None, file_bytes=5 * 1024 * 1024, backups=5):
+        self.max_lines = max_lines
+        self.pending = deque(maxlen=max_lines)  # append / popleft 本身线程安全
+        self.logger = None
+        self.log_file = None
+        if log_dir:
+            try:
+                os.makedirs(log_dir, exist_ok=True)
+                self.log_file = os.path.join(log_dir, "video_downloader.log")
+                handler = logging.handlers.RotatingFileHandler(
+                    self.log_file, maxBytes=file_bytes, backupCount=backups, encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+                self.logger = logging.getLogger(f"video_downloader.{id(self)}")
+                self.logger.propagate = False
+                self.logger.setLevel(logging.INFO)
+                self.logger.addHandler(handler)
+            except OSError as e:
+                print(f"打开日志文件失败: {e}")
+                self.log_file = None
+    
+    def write(self, message):
+        line = ANSI_ESCAPE.sub('', str(message))
+        self.pending.append(line)
+        if self.logger:
+            self.logger.info(line)
+    
+    def drain(self):
+        """取出所有待显示的行"""
+        lines = []
+        while True:
+            try:
+                lines.append(self.pending.popleft())
+            except IndexError:
+                return lines
+    
+    def set_max_lines(self, max_lines):
+        if max_lines != self.max_lines:
+            self.max_lines = max_lines
+            self.pending = deque(self.pending, maxlen=max_lines)
+    
+    def clear(self):
+        self.pending.clear()
+    
+    def close(self):
+        if self.logger:
+            for handler in list(self.logger.handlers):
+                handler.close()
+                self.logger.removeHandler(handler)
+
+
+def open_log_buffer(config):
+    return LogBuffer(max_lines=max(100, int(config.get("log_max_lines", 5000))),
+                     log_dir=os.path.join(config.config_dir, "logs"),
+                     file_bytes=int(config.get("log_file_mb", 5) * 1024 * 1024),
+                     backups=int(config.get("log_backups", 5)))
+
+
+class ProgressBus:
+    """进度总线 - 工作线程只标记变化的任务，由界面定时器合并刷新"""
+    
+    def __init__(self):
+        self._dirty = set()  # set.add / set.pop 在 GIL 下是原子操作，无需加锁
+        self.lock = threading.Lock()  # 仅保护统计计数
+        self.total = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.stats_dirty = True
+        self.added = deque()  # 下载中新增的任务 (播放列表展开)，等界面定时器插入行
+        self.finished_dirty = False  # 有任务结束，界面定时器检查是否全部完成
+    
+    def add(self, task):
+        with self.lock:
+            self.total += 1
+            self.stats_dirty = True
+        self._dirty.add(task)
+    
+    def publish(self, task):
+        self._dirty.add(task)
+    
+    def finish(self, task):
+        with self.lock:
+            if task.completed:
+                self.completed += 1
+            elif task.cancelled:
+                self.cancelled += 1
+            elif task.error:
+                self.failed += 1
+            self.stats_dirty = True
+            self.finished_dirty = True
+        self._dirty.add(task)
+    
+    def announce(self, task):
+        """工作线程新建了任务，界面需要插入一行"""
+        self.added.append(task)
+    
+    def drain_added(self):
+        tasks = []
+        while True:
+            try:
+                tasks.append(self.added.popleft())
+            except IndexError:
+                return tasks
+    
+    def take_finished(self):
+        """上次调用以来是否有任务结束"""
+        with self.lock:
+            finished, self.finished_dirty = self.finished_dirty, False
+        return finished
+    
+    def done(self):
+        """已结束的任务数 (成功、失败、取消)"""
+        return self.completed + self.failed + self.cancelled
+    
+    def drain(self):
+        """取出所有待刷新的任务"""
+        tasks = []
+        while True:
+            try:
+                tasks.append(self._dirty.pop())
+            except KeyError:
+                return tasks
+
+
+class Metrics:
+    """下载指标 - 按任务记录各阶段耗时、字节数、重试和分片数
+    
+    每次尝试结束 (完成/失败/重试/暂停/取消) 写一行 JSONL 跟踪，同时累计成
+    Prometheus 文本格式，用来判断慢在提取、CDN 传输还是 ffmpeg 处理。
+    """
+    PHASES = ('queue', 'extract', 'transfer', 'process_wait', 'process')
+    PHASE_LABELS = {'queue': "排队", 'extract': "提取", 'transfer': "传输",
+                    'process_wait': "等待处理", 'process': "处理"}
+    BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 900, float('inf'))
+    
+    def __init__(self, trace_path=None):
+        self.lock = threading.Lock()
+        self.phase_seconds = dict.fromkeys(self.PHASES, 0.0)
+        self.phase_counts = dict.fromkeys(self.PHASES, 0)
+        self.phase_buckets = {phase: [0] * len(self.BUCKETS) for phase in self.PHASES}
+        self.outcomes = {}
+        self.bytes_total = 0
+        self.fragments_total = 0
+        self.retries_total = 0
+        self.extracts_total = 0
+        self.gauges = None  # 返回 {名称: (说明, 值)} 的函数，导出时调用
+        self.trace = None
+        if trace_path:
+            try:
+                self.trace = open(trace_path, 'a', encoding='utf-8')
+            except OSError as e:
+                print(f"打开跟踪文件失败: {e}")
+    
+    def phase(self, task, name):
+        """结束任务当前阶段的计时并开始 name 阶段 (None 只结束)"""
+        now = time.monotonic()
+        with self.lock:
+            if task.phase:
+                task.phase_times[task.phase] = task.phase_times.get(task.phase, 0.0) + now - task.phase_started
+            task.phase = name
+            task.phase_started = now
+    
+    def finish(self, task, outcome):
+        """一次尝试结束 - 汇总并写跟踪，阶段计时清零给下一次尝试"""
+        self.phase(task, None)
+        with self.lock:
+            times, task.phase_times = task.phase_times, {}
+            for phase, seconds in times.items():
+                self.phase_seconds[phase] += seconds
+                self.phase_counts[phase] += 1
+                buckets = self.phase_buckets[phase]
+                for i, bound in enumerate(self.BUCKETS):
+                    if seconds <= bound:
+                        buckets[i] += 1
+            self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+            self.bytes_total += task.bytes_done
+            self.fragments_total += task.fragments
+            self.extracts_total += task.extract_count
+            if outcome == 'retry':
+                self.retries_total += 1
+            if self.trace:
+                self.trace.write(json.dumps({
+                    "time": round(time.time(), 3),
+                    "url": task.url,
+                    "title": task.title,
+                    "outcome": outcome,
+                    "attempt": task.attempts,
+                    "phases": {phase: round(seconds, 3) for phase, seconds in times.items()},
+                    "bytes": task.bytes_done,
+                    "transfer_seconds": round(task.transfer_time, 3),
+                    "fragments": task.fragments,
+                    "extracts": task.extract_count,
+                    "error_class": task.error_class,
+                    "plan": task.plan,
+                }, ensure_ascii=False) + "\n")
+                self.trace.flush()
+    
+    def summary(self):
+        """各阶段累计耗时，没有记录时返回空字符串"""
+        return " | ".join(f"{self.PHASE_LABELS[phase]} {self.phase_seconds[phase]:.1f}s"
+                          for phase in self.PHASES if self.phase_counts[phase])
+    
+    def prometheus(self):
+        """Prometheus 文本格式"""
+        lines = []
+        
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+        
+        with self.lock:
+            bucket_samples = []
+            for phase in self.PHASES:
+                for bound, count in zip(self.BUCKETS, self.phase_buckets[phase]):
+                    le = '+Inf' if bound == float('inf') else bound
+                    bucket_samples.append((f'_bucket{{phase="{phase}",le="{le}"}}', count))
+            lines.append("# HELP video_downloader_phase_seconds 每次尝试各阶段耗时")
+            lines.append("# TYPE video_downloader_phase_seconds histogram")
+            for labels, value in bucket_samples:
+                lines.append(f"video_downloader_phase_seconds{labels} {value}")
+            for phase in self.PHASES:
+                lines.append(f'video_downloader_phase_seconds_sum{{phase="{phase}"}} {self.phase_seconds[phase]:.3f}')
+                lines.append(f'video_downloader_phase_seconds_count{{phase="{phase}"}} {self.phase_counts[phase]}')
+            metric("video_downloader_attempts_total", "counter", "按结果统计的尝试次数",
+                   [(f'{{outcome="{outcome}"}}', count) for outcome, count in sorted(self.outcomes.items())])
+            metric("video_downloader_bytes_total", "counter", "已下载的字节数", [("", self.bytes_total)])
+            metric("video_downloader_fragments_total", "counter", "已下载的分片数", [("", self.fragments_total)])
+            metric("video_downloader_retries_total", "counter", "重试次数", [("", self.retries_total)])
+            metric("video_downloader_extracts_total", "counter", "信息提取次数", [("", self.extracts_total)])
+        for name, (help_text, value) in (self.gauges() if self.gauges else {}).items():
+            metric(f"video_downloader_{name}", "gauge", help_text, [("", value)])
+        return "\n".join(lines) + "\n"
+    
+    def close(self):
+        if self.trace:
+            with self.lock:
+                self.trace.close()
+                self.trace = None
+
+
+class MetricsServer:
+    """在本机端口提供 /metrics (Prometheus 文本格式)"""
+    
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        import http.server
+        
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass  # 不往 stdout/stderr 打访问日志
+        
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def open_concurrency(config, log, adaptive=None):
+    """开启自适应并发时创建 ConcurrencyController，否则返回 None"""
+    if adaptive is None:
+        adaptive = config.get("adaptive_concurrency", False)
+    if not adaptive:
+        return None
+    return ConcurrencyController(config.get("max_concurrent", 3), config.get("thread_count", 8),
+                                 config.get("max_concurrent_limit", 10), config.get("thread_count_limit", 32),
+                                 log=log)
+
+
+def retry_policy_from_config(config, max_retries=None):
+    if max_retries is None:
+        max_retries = config.get("max_retries", 3)
+    return RetryPolicy(max_retries, config.get("retry_base_delay", 2))
+
+
+def estimate_size(info):
+    """根据视频信息估算下载大小 (字节)，未知时返回 None"""
+    if not info:
+        return None
+    requested = info.get('requested_formats')
+    if requested:
+        sizes = [f.get('filesize') or f.get('filesize_approx') for f in requested]
+        if all(sizes):
+            return sum(sizes)
+    size = info.get('filesize') or info.get('filesize_approx')
+    if size:
+        return size
+    # 未经格式选择的信息按最大的格式估算 (默认下载最高画质)
+    return max((f.get('filesize') or f.get('filesize_approx') or 0
+                for f in info.get('formats') or []), default=0) or None
+
+
+class VideoSummary:
+    """视频信息摘要 - 只保留界面和调度要用的字段
+    
+    完整的 info (格式列表、分片列表、字幕等) 动辄几百 KB，超大播放列表或批量获取信息时
+    先转成摘要再保存，原始 info 随即释放。
+    """
+    __slots__ = ('url', 'id', 'title', 'extractor', 'duration', 'is_playlist', 'entry_count',
+                 'best_height', 'size', 'heights', 'best', 'format_id', 'selection')
+    
+    def __init__(self, url=None):
+        self.url = url
+        self.id = None
+        self.title = None
+        self.extractor = None
+        self.duration = None
+        self.is_playlist = False
+        self.entry_count = 0
+        self.best_height = 0
+        self.size = None  # 预估下载大小 (字节)
+        self.heights = []  # [(高度, 编码列表)]，从高到低，最多 8 档
+        self.best = None  # 最高画质中最大的格式 (编码, 扩展名, 码率, 大小)
+        self.format_id = None  # 已选好的格式
+        self.selection = None  # 判断封装方式要用的最少字段 (见 plan_container)
+    
+    @classmethod
+    def from_info(cls, info, url=None):
+        summary = cls(url or info.get('webpage_url') or info.get('original_url'))
+        summary.id = info.get('id')
+        summary.title = info.get('title')
+        summary.extractor = info.get('extractor_key') or info.get('ie_key')
+        summary.duration = info.get('duration')
+        if info.get('_type') in ('playlist', 'multi_video'):
+            summary.is_playlist = True
+            entries = info.get('entries') or []
+            summary.entry_count = len(entries) if isinstance(entries, (list, tuple)) else info.get('playlist_count') or 0
+            return summary
+        
+        codecs = {}
+        for f in info.get('formats') or []:
+            height = f.get('height')
+            if height and f.get('vcodec') != 'none':
+                codecs.setdefault(height, set()).add((f.get('vcodec') or 'unknown')[:10])
+        if codecs:
+            ordered = sorted(codecs, reverse=True)
+            summary.best_height = ordered[0]
+            summary.heights = [(h, sorted(codecs[h])) for h in ordered[:8]]
+            best = max((f for f in info['formats'] if f.get('height') == ordered[0] and f.get('vcodec') != 'none'),
+                       key=lambda f: (f.get('filesize') or f.get('filesize_approx') or 0, f.get('vbr') or 0))
+            summary.best = (best.get('vcodec'), best.get('ext'), best.get('vbr'),
+                            best.get('filesize') or best.get('filesize_approx'))
+        summary.size = estimate_size(info)
+        summary.format_id = info.get('format_id')
+        if summary.format_id:
+            keys = ('vcodec', 'acodec', 'ext')
+            summary.selection = {
+                'ext': info.get('ext'),
+                'requested_formats': [{k: f.get(k) for k in keys} for f in info.get('requested_formats') or []],
+            }
+        return summary
+    
+    def metadata(self):
+        """保存到任务库的元数据"""
+        return json.dumps({
+            "id": self.id,
+            "extractor": self.extractor,
+            "duration": self.duration,
+            "type": "playlist" if self.is_playlist else "video",
+        }, ensure_ascii=False)
+
+
+def drop_unselected_formats(info, keep_subtitles=False):
+    """格式选好后只留下选中的格式 (和需要时的字幕)，下载期间不再持有完整格式列表"""
+    selected = info.get('requested_formats') or ([info] if info.get('format_id') else None)
+    if not selected:
+        return info
+    ids = {f.get('format_id') for f in selected}
+    info['formats'] = [f for f in info.get('formats') or [] if f.get('format_id') in ids]
+    if not keep_subtitles:
+        info.pop('automatic_captions', None)
+        info.pop('subtitles', None)
+    return info
+
+
+def format_rate(bytes_per_sec):
+    """字节/秒 转为显示用字符串"""
+    if bytes_per_sec >= 1024 * 1024:
+        return f"{bytes_per_sec / 1024 / 1024:.1f}MB/s"
+    return f"{bytes_per_sec / 1024:.0f}KB/s"
+
+
+def format_bytes(size):
+    if size >= 1024 ** 3:
+        return f"{size / 1024 ** 3:.2f}GB"
+    if size >= 1024 * 1024:
+        return f"{size / 1024 / 1024:.1f}MB"
+    return f"{size / 1024:.0f}KB"
+
+
+def format_eta(seconds):
+    """剩余秒数转为 mm:ss / h:mm:ss，未知时返回空字符串"""
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+def task_speed_text(task):
+    """任务列表 "速度" 列: 速度加剩余时间"""
+    if not task.speed or task.completed:
+        return ""
+    eta = format_eta(task.eta)
+    return f"{format_rate(task.speed)} {eta}" if eta else format_rate(task.speed)
+
+
+class BandwidthScheduler:
+    """全局带宽调度 - 所有任务共享一个令牌桶，总速度不超过上限
+    
+    在 yt-dlp 的进度回调里按本次新下载的字节数扣令牌，不够就让该下载线程睡眠。
+    fair 模式下每个正在下载的任务另有一个按权重分得的令牌桶，避免大文件抢光带宽。
+    上限可在运行中随时调整，0 表示不限速 (仍统计总速度)。
+    """
+    WINDOW = 3.0  # 统计总速度的时间窗口 (秒)
+    
+    def __init__(self, rate=0, fair=True):
+        self.rate = rate
+        self.fair = fair
+        self.lock = threading.Lock()
+        self.tokens = 0.0
+        self.updated = time.time()
+        self.active = {}  # task -> [令牌, 上次补充时间]
+        self.seen = {}  # task -> (文件名, 已下载字节)
+        self.samples = deque()  # (时间, 字节)
+        self.window_bytes = 0
+    
+    def set_rate(self, rate, fair=None):
+        with self.lock:
+            self.rate = max(0, rate)
+            if fair is not None:
+                self.fair = fair
+            # 调整后重新开始计算，之前欠下的令牌一笔勾销
+            self.tokens = 0.0
+            self.updated = time.time()
+            for bucket in self.active.values():
+                bucket[0] = 0.0
+                bucket[1] = self.updated
+    
+    def release(self, task):
+        """任务下载结束 (或进入后处理)，不再参与分配带宽"""
+        with self.lock:
+            self.active.pop(task, None)
+            self.seen.pop(task, None)
+    
+    def _delta(self, task, d):
+        filename = d.get('filename') or d.get('tmpfilename')
+        downloaded = d.get('downloaded_bytes') or 0
+        last_name, last_bytes = self.seen.get(task, (None, 0))
+        self.seen[task] = (filename, downloaded)
+        if filename != last_name or downloaded < last_bytes:
+            return downloaded  # 开始了新文件 (如视频下完接着下音频)
+        return downloaded - last_bytes
+    
+    def consume(self, task, d):
+        """处理一次进度回调，需要限速时阻塞调用线程"""
+        now = time.time()
+        with self.lock:
+            nbytes = self._delta(task, d)
+            if nbytes <= 0:
+                return
+            self.samples.append((now, nbytes))
+            self.window_bytes += nbytes
+            while self.samples and now - self.samples[0][0] > self.WINDOW:
+                self.window_bytes -= self.samples.popleft()[1]
+            
+            if self.rate <= 0:
+                return
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate) - nbytes
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+            
+            if self.fair:
+                bucket = self.active.setdefault(task, [0.0, now])
+                total_weight = sum(t.weight for t in self.active)
+                share = self.rate * task.weight / total_weight
+                bucket[0] = min(share, bucket[0] + (now - bucket[1]) * share) - nbytes
+                bucket[1] = now
+                if bucket[0] < 0:
+                    wait = max(wait, -bucket[0] / share)
+        # 分段等待，任务暂停或取消时立即返回
+        deadline = now + wait
+        while wait > 0 and not (task.paused or task.cancelled):
+            time.sleep(min(wait, 0.2))
+            wait = deadline - time.time()
+    
+    def throughput(self):
+        """最近几秒的总下载速度 (字节/秒)"""
+        with self.lock:
+            now = time.time()
+            while self.samples and now - self.samples[0][0] > self.WINDOW:
+                self.window_bytes -= self.samples.popleft()[1]
+            return self.window_bytes / self.WINDOW
+    
+    def status_text(self):
+        text = f"⚡ {format_rate(self.throughput())}"
+        if self.rate > 0:
+            text += f" (上限 {format_rate(self.rate)})"
+        return text
+
+
+class ConcurrencyController:
+    """自适应并发 (AIMD) - 按站点统计吞吐和限流错误，运行中调整同时下载数和分片线程数
+    
+    每个站点完成一轮 (成功数达到当前并发数) 后，如果站点总吞吐比上一轮高 5% 以上，
+    同时下载数和分片线程数各加 1；遇到 429 / 5xx / 连接被重置这类限流错误则都减半。
+    """
+    THROTTLE_PATTERNS = ('429', 'too many requests', 'rate limit', 'rate-limit', 'timed out',
+                         'connection reset', 'http error 5', 'remote end closed')
+    
+    def __init__(self, tasks=3, fragments=8, max_tasks=10, max_fragments=32, log=None):
+        self.start_tasks = max(1, min(tasks, max_tasks))
+        self.start_fragments = max(1, min(fragments, max_fragments))
+        self.max_tasks = max_tasks
+        self.max_fragments = max_fragments
+        self.log = log or (lambda message: None)
+        self.cond = threading.Condition()
+        self.domains = {}
+    
+    def _state(self, domain):
+        if domain not in self.domains:
+            self.domains[domain] = {
+                "tasks": self.start_tasks,
+                "fragments": self.start_fragments,
+                "active": 0,
+                "successes": 0,
+                "speed": None,  # 单个任务吞吐的 EWMA (字节/秒)
+                "last_total": None,  # 上一轮的站点总吞吐
+            }
+        return self.domains[domain]
+    
+    def acquire(self, domain, cancelled):
+        """等待该站点有空位，返回本任务应使用的分片线程数；取消时返回 None"""
+        with self.cond:
+            state = self._state(domain)
+            while state["active"] >= state["tasks"]:
+                if cancelled():
+                    return None
+                self.cond.wait(0.5)
+            state["active"] += 1
+            return state["fragments"]
+    
+    def is_throttled(self, error):
+        error = (error or "").lower()
+        return any(pattern in error for pattern in self.THROTTLE_PATTERNS)
+    
+    def release(self, domain, nbytes, seconds, error=None):
+        with self.cond:
+            state = self._state(domain)
+            state["active"] -= 1
+            if error:
+                if self.is_throttled(error):
+                    state["tasks"] = max(1, state["tasks"] // 2)
+                    state["fragments"] = max(1, state["fragments"] // 2)
+                    state["successes"] = 0
+                    self._report(domain, state, "📉 限流")
+            elif nbytes and seconds > 0:
+                speed = nbytes / seconds
+                state["speed"] = speed if state["speed"] is None else 0.7 * state["speed"] + 0.3 * speed
+                state["successes"] += 1
+                if state["successes"] >= state["tasks"]:
+                    state["successes"] = 0
+                    total = state["speed"] * state["tasks"]
+                    if state["last_total"] is None or total > state["last_total"] * 1.05:
+                        grown = (state["tasks"] < self.max_tasks or state["fragments"] < self.max_fragments)
+                        state["tasks"] = min(self.max_tasks, state["tasks"] + 1)
+                        state["fragments"] = min(self.max_fragments, state["fragments"] + 1)
+                        if grown:
+                            self._report(domain, state, "📈 提速")
+                    state["last_total"] = total
+            self.cond.notify_all()
+    
+    def _report(self, domain, state, reason):
+        speed = format_rate(state["speed"] * state["tasks"]) if state["speed"] else "N/A"
+        self.log(f"{reason} {domain}: 同时下载 {state['tasks']} | 分片线程 {state['fragments']} | 估计吞吐 {speed}")
+
+
+class RetryPolicy:
+    """失败重试策略 - 把错误分成 可重试 / 需重新提取 / 不可恢复 三类
+    
+    可重试: 429、5xx、超时、连接被重置等临时错误；
+    需重新提取: 403 等格式链接过期的错误，丢掉缓存的信息后重新提取；
+    其余 (404、不支持的链接、私密视频等) 不重试。
+    等待时间按指数退避并加随机抖动，服务器给了 Retry-After 时不少于它。
+    """
+    RETRYABLE = "retryable"
+    REEXTRACT = "reextract"
+    FATAL = "fatal"
+    LABELS = {RETRYABLE: "可重试", REEXTRACT: "重新提取", FATAL: "不可恢复"}
+    
+    FATAL_PATTERNS = ('用户取消', 'http error 404', 'http error 401', 'unsupported url', 'private video',
+                      'video unavailable', 'not available', 'has been removed', 'copyright',
+                      'no video formats', 'requested format is not available', 'sign in to confirm')
+    REEXTRACT_PATTERNS = ('http error 403', 'forbidden', 'http error 410', 'expired', 'signature')
+    RETRYABLE_PATTERNS = ConcurrencyController.THROTTLE_PATTERNS + (
+        'timeout', 'temporary failure', 'incomplete read', 'incompleteread', 'connection aborted',
+        'connection refused', 'eof occurred', 'unable to connect', 'name resolution', 'did not get any data')
+    
+    def __init__(self, max_retries=3, base_delay=2.0, max_delay=300.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def classify(self, error):
+        error = (error or "").lower()
+        for cls, patterns in ((self.FATAL, self.FATAL_PATTERNS),
+                              (self.REEXTRACT, self.REEXTRACT_PATTERNS),
+                              (self.RETRYABLE, self.RETRYABLE_PATTERNS)):
+            if any(pattern in error for pattern in patterns):
+                return cls
+        return self.FATAL
+    
+    def should_retry(self, error_class, attempts):
+        return error_class != self.FATAL and attempts < self.max_retries
+    
+    def delay(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待秒数"""
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay *= random.uniform(0.5, 1.0)
+        if retry_after:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+    
+    @staticmethod
+    def retry_after(exc):
+        """沿异常链查找 HTTP 响应里的 Retry-After (秒数或日期)"""
+        seen = set()
+        while exc is not None and id(exc) not in seen:
+            seen.add(id(exc))
+            response = getattr(exc, 'response', None)
+            headers = getattr(response, 'headers', None) or getattr(exc, 'headers', None)
+            value = headers.get('Retry-After') if headers else None
+            if value:
+                try:
+                    return max(0.0, float(value))
+                except ValueError:
+                    try:
+                        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+                    except (TypeError, ValueError):
+                        pass
+            exc_info = getattr(exc, 'exc_info', None)
+            exc = (exc_info[1] if exc_info else None) or exc.__cause__ or exc.__context__
+        return None
+
+
+class PipelineStages:
+    """下载和后处理分成两个阶段，各自限制并发并统计排队数
+    
+    文件落盘后立即让出下载槽位，合并/转码在单独的处理槽位 (默认 CPU 核数) 里排队，
+    对比两个阶段的排队数就能看出瓶颈在网络还是 CPU。
+    """
+    DOWNLOAD = "download"
+    PROCESS = "process"
+    
+    def __init__(self, download_slots, process_slots):
+        self.slots = {self.DOWNLOAD: download_slots, self.PROCESS: process_slots}
+        self.active = dict.fromkeys(self.slots, 0)
+        self.waiting = dict.fromkeys(self.slots, 0)
+        self.cond = threading.Condition()
+    
+    def enter(self, stage, interrupted=lambda: False):
+        """等到该阶段有空位并占用，等待期间 interrupted() 为真时放弃并返回 False"""
+        with self.cond:
+            self.waiting[stage] += 1
+            try:
+                while self.active[stage] >= self.slots[stage]:
+                    if interrupted():
+                        return False
+                    self.cond.wait(0.5)
+            finally:
+                self.waiting[stage] -= 1
+            self.active[stage] += 1
+            return True
+    
+    def leave(self, stage):
+        with self.cond:
+            self.active[stage] -= 1
+            self.cond.notify_all()
+    
+    def depths(self, queued=0):
+        """各阶段 {'active': 进行中, 'waiting': 排队}，queued 为调度队列里还没轮到的任务数"""
+        with self.cond:
+            return {
+                self.DOWNLOAD: {"active": self.active[self.DOWNLOAD],
+                                "waiting": self.waiting[self.DOWNLOAD] + queued},
+                self.PROCESS: {"active": self.active[self.PROCESS],
+                               "waiting": self.waiting[self.PROCESS]},
+            }
+    
+    def status_text(self, queued=0):
+        depths = self.depths(queued)
+        download, process = depths[self.DOWNLOAD], depths[self.PROCESS]
+        return (f"⬇️ {download['active']}/{self.slots[self.DOWNLOAD]} 排队 {download['waiting']} | "
+                f"⚙️ {process['active']}/{self.slots[self.PROCESS]} 排队 {process['waiting']}")
+
+
+class TaskInterrupted(Exception):
+    """任务被暂停或取消 (在进度回调里抛出，中断 yt-dlp 的下载)"""
+
+
+class ChildProcesses:
+    """记录 yt-dlp 启动的子进程 (ffmpeg 等) 属于哪个线程，暂停/取消任务时一并结束"""
+    lock = threading.Lock()
+    by_thread = {}
+    installed = False
+    
+    @classmethod
+    def install(cls):
+        with cls.lock:
+            if cls.installed:
+                return
+            cls.installed = True
+        popen = yt_dlp.utils.Popen
+        original_init = popen.__init__
+        
+        def init(proc, *args, **kwargs):
+            original_init(proc, *args, **kwargs)
+            cls.register(proc)
+        popen.__init__ = init
+    
+    @classmethod
+    def register(cls, proc, ident=None):
+        """ident 为发起任务的线程，默认当前线程 (转码池里启动的 ffmpeg 记在任务线程名下)"""
+        ident = ident or threading.get_ident()
+        with cls.lock:
+            procs = [p for p in cls.by_thread.get(ident, []) if p.poll() is None]
+            procs.append(proc)
+            cls.by_thread[ident] = procs
+    
+    @classmethod
+    def kill(cls, ident=None):
+        """结束某个线程 (None 为所有线程) 启动的、仍在运行的子进程"""
+        with cls.lock:
+            if ident is None:
+                procs = [p for group in cls.by_thread.values() for p in group]
+                cls.by_thread.clear()
+            else:
+                procs = cls.by_thread.pop(ident, [])
+        for proc in procs:
+            if proc.poll() is None:
+                try:
+                    proc.kill()
+                except OSError:
+                    pass
+
+
+class FragmentLedger:
+    """分片账本 - HLS/DASH 下载时记下每个写入 .part 的分片的位置、大小和 SHA-1
+    
+    账本是 .part 旁边的 .frags 文件 (一行一个分片，只追加)，和 yt-dlp 的 .ytdl 一样按文件名对应，
+    暂停、程序崩溃后从任务库继续时都能找到：截掉 .part 末尾没记账的半截分片，只下载缺的分片。
+    下载完先逐段校验整个文件，只重新获取校验失败的分片并原位写回。
+    分片文件用 mmap 映射后直接写入 .part，不再整段读进内存。
+    """
+    SUFFIX = '.frags'
+    FD_NAMES = ('dashsegments', 'hlsnative')
+    COUNTERS = ('reused', 'fetched', 'repaired')
+    lock = threading.Lock()
+    stats = {}  # 线程 -> {"reused": 续传复用的分片, "fetched": 新下载的分片, "repaired": 校验失败重下的分片}
+    installed = False
+    stock_read = None  # 替换前的 FragmentFD._read_fragment
+    # 替换或调用的 FragmentFD 私有方法及其位置参数，yt-dlp 升级后对不上就不启用账本
+    SIGNATURES = {
+        '_prepare_and_start_frag_download': ('self', 'ctx', 'info_dict'),
+        '_prepare_frag_download': ('self', 'ctx'),
+        '_start_frag_download': ('self', 'ctx', 'info_dict'),
+        'download_and_append_fragments': ('self', 'ctx', 'fragments', 'info_dict'),
+        '_download_fragment': ('self', 'ctx', 'frag_url', 'info_dict', 'headers', 'request_data'),
+        '_read_fragment': ('self', 'ctx'),
+        '_append_fragment': ('self', 'ctx', 'frag_content'),
+        '_finish_frag_download': ('self', 'ctx', 'info_dict'),
+        'decrypter': ('self', 'info_dict'),
+    }
+    
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # 分片序号 -> (偏移, 大小, sha1)
+        self.sources = {}  # 分片序号 -> yt-dlp 的分片信息 (链接、字节范围、加密)，校验失败时重新获取
+        self.resume_index = 0
+    
+    @classmethod
+    def compatible(cls, fragment_fd):
+        """检查当前 yt-dlp 的 FragmentFD 是否还是账本依赖的那些方法和参数"""
+        for name, expected in cls.SIGNATURES.items():
+            method = getattr(fragment_fd, name, None)
+            if not callable(method):
+                return False
+            try:
+                parameters = inspect.signature(method).parameters.values()
+            except (TypeError, ValueError):
+                return False
+            positional = tuple(p.name for p in parameters
+                               if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD))
+            if positional != expected:
+                return False
+        return True
+    
+    @classmethod
+    def install(cls, log=print):
+        with cls.lock:
+            if cls.installed:
+                return
+            cls.installed = True
+        fragment_fd = yt_dlp.downloader.fragment.FragmentFD
+        if not cls.compatible(fragment_fd):
+            # 替换对不上的私有方法会让所有 HLS/DASH 下载失败，宁可不用账本
+            log("⚠️ 当前 yt-dlp 的分片下载接口有变化，未启用分片账本 (HLS/DASH 按 yt-dlp 默认方式续传)")
+            return
+        download_and_append = fragment_fd.download_and_append_fragments
+        read = cls.stock_read = fragment_fd._read_fragment
+        append = fragment_fd._append_fragment
+        finish = fragment_fd._finish_frag_download
+        
+        def prepare_and_start(fd, ctx, info_dict):
+            fd._prepare_frag_download(ctx)
+            ledger = cls.attach(fd, ctx, info_dict)
+            fd._start_frag_download(ctx, info_dict)
+            if ledger:
+                # 让 HLS/DASH 列出全部分片 (修复旧分片要用到链接)，已有的由 track 跳过
+                # (DASH 的分片列表是边下边生成的，这里不能再改回续传位置)
+                ctx['fragment_index'] = 0
+        
+        def download_and_append_fragments(fd, ctx, fragments, info_dict, **kwargs):
+            ledger = ctx.get('ledger')
+            if ledger:
+                fragments = ledger.track(fragments)
+            return download_and_append(fd, ctx, fragments, info_dict, **kwargs)
+        
+        def read_fragment(fd, ctx):
+            ledger = ctx.get('ledger')
+            path = ctx.get('fragment_filename_sanitized')
+            if not ledger or not path or ledger.encrypted(cls.fragment_index(ctx)):
+                return read(fd, ctx)
+            try:
+                with open(path, 'rb') as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):  # 空文件不能映射，交给原来的逻辑
+                return read(fd, ctx)
+        
+        def append_fragment(fd, ctx, frag_content):
+            ledger = ctx.get('ledger')
+            if not ledger:
+                return append(fd, ctx, frag_content)
+            offset = ctx['dest_stream'].tell()
+            size = len(frag_content)
+            digest = hashlib.sha1(frag_content).hexdigest()
+            if isinstance(frag_content, mmap.mmap):
+                try:
+                    ctx['dest_stream'].write(frag_content)
+                finally:
+                    frag_content.close()  # 先解除映射，Windows 上才能删掉分片文件
+                frag_content = b''
+            index = cls.fragment_index(ctx)
+            append(fd, ctx, frag_content)
+            ledger.record(index, offset, size, digest)
+            cls.count('fetched')
+        
+        def finish_frag_download(fd, ctx, info_dict):
+            ledger = ctx.pop('ledger', None)
+            if ledger:
+                ctx['dest_stream'].flush()
+                error = ledger.verify_and_repair(fd, ctx, info_dict)
+                if error:
+                    ctx['dest_stream'].close()
+                    fd.report_error(error)
+                    return False
+            if not finish(fd, ctx, info_dict):
+                return False
+            if ledger:
+                ledger.remove()
+            return True
+        
+        fragment_fd._prepare_and_start_frag_download = prepare_and_start
+        fragment_fd.download_and_append_fragments = download_and_append_fragments
+        fragment_fd._read_fragment = read_fragment
+        fragment_fd._append_fragment = append_fragment
+        fragment_fd._finish_frag_download = finish_frag_download
+    
+    @staticmethod
+    def fragment_index(ctx):
+        """当前要写入的分片序号 - 多线程下载时 ctx['fragment_index'] 会被各分片线程的进度回调改写，
+        以分片文件名 (<.part>-Frag<序号>) 为准"""
+        path = ctx.get('fragment_filename_sanitized') or ''
+        _, sep, index = path.rpartition('-Frag')
+        return int(index) if sep and index.isdigit() else ctx['fragment_index']
+    
+    @classmethod
+    def attach(cls, fd, ctx, info_dict):
+        """.part 打开后调用：按账本确定从哪个分片继续，返回账本 (不适用的下载返回 None)"""
+        if (fd.FD_NAME not in cls.FD_NAMES or ctx.get('live') or ctx['tmpfilename'] == '-'
+                or info_dict.get('ext') == 'vtt'):
+            return None
+        ledger = cls(ctx['filename'] + cls.SUFFIX)
+        resume_len = ctx['complete_frags_downloaded_bytes']
+        if resume_len and fd.params.get('continuedl', True) and ledger.load(resume_len):
+            # 账本说了算：没记账的尾巴 (写到一半崩溃) 截掉重下
+            end = ledger.end()
+            ctx['dest_stream'].truncate(end)
+            ctx['dest_stream'].seek(end)
+            ctx['fragment_index'] = max(ledger.entries)
+            ctx['complete_frags_downloaded_bytes'] = end
+            cls.count('reused', len(ledger.entries))
+        elif not resume_len:
+            ledger.remove()
+        ledger.resume_index = ctx['fragment_index']
+        ctx['ledger'] = ledger
+        return ledger
+    
+    def load(self, resume_len):
+        """读入账本，只保留首尾相接且落在 .part 范围内的分片，返回是否还有可用的分片"""
+        entries = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        index, offset, size, digest = line.split()
+                        entries[int(index)] = (int(offset), int(size), digest)
+                    except ValueError:
+                        continue  # 崩溃时写了一半的行
+        except OSError:
+            return False
+        end = None
+        for index in sorted(entries):
+            offset, size, digest = entries[index]
+            if (end is not None and offset != end) or offset + size > resume_len:
+                break
+            self.entries[index] = entries[index]
+            end = offset + size
+        if len(self.entries) != len(entries):
+            self._rewrite()
+        return bool(self.entries)
+    
+    def end(self):
+        offset, size, _ = self.entries[max(self.entries)]
+        return offset + size
+    
+    def track(self, fragments):
+        """记下每个分片的来源，只把还没下载的交给 yt-dlp"""
+        for fragment in fragments:
+            self.sources[fragment['frag_index']] = fragment
+            if fragment['frag_index'] > self.resume_index:
+                yield fragment
+    
+    def encrypted(self, index):
+        return (self.sources.get(index) or {}).get('decrypt_info', {}).get('METHOD') == 'AES-128'
+    
+    def record(self, index, offset, size, digest):
+        self.entries[index] = (offset, size, digest)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(f"{index}\t{offset}\t{size}\t{digest}\n")
+    
+    def _rewrite(self):
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.writelines(f"{index}\t{offset}\t{size}\t{digest}\n"
+                         for index, (offset, size, digest) in sorted(self.entries.items()))
+    
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+    
+    def verify(self, path):
+        """逐段校验 .part，返回大小或 SHA-1 对不上的分片序号"""
+        bad = []
+        buffer = memoryview(bytearray(1 << 20))
+        with open(path, 'rb', buffering=0) as f:
+            for index, (offset, size, digest) in sorted(self.entries.items()):
+                f.seek(offset)
+                sha1 = hashlib.sha1()
+                left = size
+                while left:
+                    read = f.readinto(buffer[:min(left, len(buffer))])
+                    if not read:
+                        break
+                    sha1.update(buffer[:read])
+                    left -= read
+                if left or sha1.hexdigest() != digest:
+                    bad.append(index)
+        return bad
+    
+    def verify_and_repair(self, fd, ctx, info_dict):
+        """校验整个文件，重新获取损坏的分片写回原位，无法修复时返回错误信息"""
+        bad = self.verify(ctx['tmpfilename'])
+        for index in bad:
+            offset, size, digest = self.entries[index]
+            content = self._refetch(fd, ctx, info_dict, index)
+            if content is None:
+                return f"分片 {index} 校验失败，重新下载也没有成功"
+            if len(content) != size or hashlib.sha1(content).hexdigest() != digest:
+                # 服务器上的分片变了，不能原位替换，从这里往后重新下载
+                with open(ctx['tmpfilename'], 'r+b') as f:
+                    f.truncate(offset)
+                self.entries = {i: entry for i, entry in self.entries.items() if i < index}
+                self._rewrite()
+                return f"分片 {index} 和之前下载的内容不一致，已从这里截断，重试时继续下载"
+            with open(ctx['tmpfilename'], 'r+b') as f:
+                f.seek(offset)
+                f.write(content)
+            self.count('repaired')
+        return None
+    
+    def _refetch(self, fd, ctx, info_dict, index):
+        fragment = self.sources.get(index)
+        if not fragment:
+            return None
+        headers = dict(info_dict.get('http_headers') or {})
+        byte_range = fragment.get('byte_range')
+        if byte_range:
+            headers['Range'] = f"bytes={byte_range['start']}-{byte_range['end'] - 1}"
+        ctx['fragment_index'] = index
+        try:
+            if not fd._download_fragment(ctx, fragment['url'], info_dict, headers):
+                return None
+            # 用原来的读取 (返回 bytes)：删分片文件前不能还映射着，Windows 上删不掉
+            content = fd.decrypter(info_dict)(fragment, FragmentLedger.stock_read(fd, ctx))
+        except (yt_dlp.utils.YoutubeDLError, OSError):
+            return None
+        fd.try_remove(ctx.pop('fragment_filename_sanitized'))
+        return content
+    
+    @classmethod
+    def count(cls, name, n=1):
+        with cls.lock:
+            stats = cls.stats.setdefault(threading.get_ident(), dict.fromkeys(cls.COUNTERS, 0))
+            stats[name] += n
+    
+    @classmethod
+    def take_stats(cls):
+        """取走当前线程 (下载任务) 累计的分片计数"""
+        with cls.lock:
+            return cls.stats.pop(threading.get_ident(), None) or dict.fromkeys(cls.COUNTERS, 0)
+
+
+class AudioTranscoder:
+    """音频转码池 - 按 CPU 核数同时运行多个 ffmpeg (每个只用一个线程)
+    
+    一次下载可以输出多种格式/码率；源编码和目标一致时直接复制音轨，不重新编码。
+    只用 libmp3lame / libopus 等软件编码器，不依赖硬件加速。
+    """
+    # 格式 -> (编码器, 扩展名)
+    ENCODERS = {
+        "mp3": ("libmp3lame", "mp3"),
+        "opus": ("libopus", "opus"),
+        "m4a": ("aac", "m4a"),
+        "aac": ("aac", "m4a"),
+        "flac": ("flac", "flac"),
+        "wav": ("pcm_s16le", "wav"),
+        "vorbis": ("libvorbis", "ogg"),
+    }
+    # 格式 -> 可以直接复制的源编码 (yt-dlp 的 acodec 前缀)
+    SOURCE_CODECS = {
+        "mp3": r"^mp3",
+        "opus": r"^opus",
+        "m4a": r"^mp4a",
+        "aac": r"^mp4a",
+        "flac": r"^flac",
+        "vorbis": r"^vorbis",
+    }
+    
+    def __init__(self, ffmpeg, workers=0):
+        self.ffmpeg = ffmpeg
+        self.workers = workers or os.cpu_count() or 2
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transcode")
+        self.lock = threading.Lock()
+        self.encoded = 0
+        self.copied = 0
+    
+    @classmethod
+    def parse_outputs(cls, formats, qualities="0"):
+        """"mp3,opus" + "320,128" -> [(mp3, 320), (mp3, 128), (opus, 320), (opus, 128)]"""
+        fmts = [f.strip().lower() for f in str(formats).split(",") if f.strip()]
+        quals = [q.strip().lower().rstrip("k") for q in str(qualities).split(",") if q.strip()] or ["0"]
+        for fmt in fmts:
+            if fmt not in cls.ENCODERS:
+                raise ValueError(f"不支持的音频格式: {fmt}")
+        for qual in quals:
+            if not qual.isdigit():
+                raise ValueError(f"无效的音频质量: {qual}")
+        return [(fmt, qual) for fmt in fmts for qual in quals]
+    
+    @classmethod
+    def matches(cls, fmt, acodec):
+        pattern = cls.SOURCE_CODECS.get(fmt)
+        return bool(pattern and acodec and re.match(pattern, acodec))
+    
+    def command(self, source, target, fmt, quality, copy):
+        cmd = [self.ffmpeg, '-y', '-loglevel', 'error', '-i', source, '-vn', '-threads', '1']
+        if copy:
+            return cmd + ['-c:a', 'copy', target]
+        encoder = self.ENCODERS[fmt][0]
+        cmd += ['-c:a', encoder]
+        if quality != "0" and encoder not in ('flac', 'pcm_s16le'):
+            cmd += ['-b:a', f'{quality}k']
+        elif encoder == 'libmp3lame':
+            cmd += ['-q:a', '0']  # 最高质量 VBR
+        return cmd + [target]
+    
+    def plan(self, source, acodec, outputs):
+        """-> [(目标路径, 格式, 质量, 是否直接复制)]"""
+        base = os.path.splitext(source)[0]
+        per_format = {}
+        for fmt, _ in outputs:
+            per_format[fmt] = per_format.get(fmt, 0) + 1
+        jobs = []
+        for fmt, quality in outputs:
+            ext = self.ENCODERS[fmt][1]
+            multiple = per_format[fmt] > 1
+            # 同一格式要多个码率时各自编码，不然复制出来都一样
+            copy = self.matches(fmt, acodec) and not multiple
+            target = f"{base}.{quality}k.{ext}" if multiple else f"{base}.{ext}"
+            jobs.append((target, fmt, quality, copy))
+        return jobs
+    
+    def transcode(self, source, acodec, outputs, owner=None, interrupted=None):
+        """把一个下载好的文件转成所有要求的输出，返回输出路径列表
+        
+        owner 为任务线程，暂停/取消时一起结束 ffmpeg；interrupted 返回 True 时还没开始的输出不再转码。
+        """
+        jobs = self.plan(source, acodec, outputs)
+        futures = []
+        for target, fmt, quality, copy in jobs:
+            if copy and target == source:
+                with self.lock:
+                    self.copied += 1
+                continue  # 下载的文件就是要的格式
+            futures.append(self.executor.submit(
+                self._run, source, target, fmt, quality, copy, owner, interrupted))
+        errors = [future.exception() for future in futures if future.exception()]
+        for error in errors:
+            if isinstance(error, TaskInterrupted):
+                raise error  # 暂停/取消原样抛出，不算转码失败
+        if errors:
+            raise Exception(f"ffmpeg 转码失败: {errors[0]}")
+        outputs = [target for target, *_ in jobs]
+        if source not in outputs and os.path.exists(source):
+            os.remove(source)
+        return outputs
+    
+    def _run(self, source, target, fmt, quality, copy, owner, interrupted):
+        if interrupted and interrupted():
+            raise TaskInterrupted()
+        # 目标和源文件同名时先写到临时文件
+        output = f"{target}.tmp{os.path.splitext(target)[1]}" if target == source else target
+        kwargs = {}
+        if sys.platform == 'win32':
+            kwargs['creationflags'] = subprocess.CREATE_NO_WINDOW
+        proc = subprocess.Popen(self.command(source, output, fmt, quality, copy),
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, **kwargs)
+        ChildProcesses.register(proc, owner)
+        _, stderr = proc.communicate()
+        if proc.returncode != 0:
+            if os.path.exists(output):
+                os.remove(output)
+            if interrupted and interrupted():
+                raise TaskInterrupted()  # 暂停/取消时 ffmpeg 被结束
+            message = stderr.decode('utf-8', 'replace').strip().splitlines()
+            raise Exception(message[-1] if message else f"退出码 {proc.returncode}")
+        if output != target:
+            os.replace(output, target)
+        with self.lock:
+            if copy:
+                self.copied += 1
+            else:
+                self.encoded += 1
+    
+    def summary(self):
+        if not self.encoded and not self.copied:
+            return ""
+        return f"编码 {self.encoded} | 直接复制 {self.copied}"
+    
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def audio_outputs_for(options):
+    """音频模式的所有输出 [(格式, 质量)]：主格式/质量 (可用逗号分隔多个) 加上额外输出 "opus:128, flac" """
+    outputs = AudioTranscoder.parse_outputs(options["audio_format"], options["audio_quality"])
+    for item in str(options.get("audio_extra") or "").split(","):
+        if item.strip():
+            fmt, _, qual = item.partition(":")
+            outputs += AudioTranscoder.parse_outputs(fmt, qual or "0")
+    # 去重并保持顺序
+    return list(dict.fromkeys(outputs))
+
+
+class DownloadListener:
+    """下载事件监听器 - 下载引擎通过它通知界面 (GUI / 命令行)
+    
+    回调都在工作线程中调用，实现方需自行保证线程安全。
+    任务进度不走回调，由 DownloadManager.progress 总线按需拉取。
+    """
+    
+    def on_log(self, message):
+        pass
+    
+    def on_task_added(self, task):
+        """下载过程中新增了任务 (播放列表展开)"""
+        pass
+    
+    def on_task_finished(self, task):
+        pass
 
 
 class DownloadManager:
     """下载管理器 - 支持多线程批量下载"""
     
-    def __init__(self, app, max_workers=3):
-        self.app = app
+    def __init__(self, listener, max_workers=3, job_store=None, archive=None, info_cache=None,
+                 bandwidth=None, concurrency=None, retry=None, shortest_first=False, postprocess_workers=0,
+                 container=None, allow_transcode=False, audio_outputs=None, ffmpeg=None, metrics=None):
+        self.listener = listener
+        self.metrics = metrics or Metrics()
+        self.metrics.gauges = self.gauges
+        self.audio_outputs = audio_outputs
+        self.ffmpeg = ffmpeg
+        self.transcoder = AudioTranscoder(ffmpeg, postprocess_workers) if audio_outputs and ffmpeg else None
+        self.container = container
+        self.allow_transcode = allow_transcode
+        self.plan_counts = dict.fromkeys(PLAN_LABELS, 0)
+        self.shortest_first = shortest_first
+        self.retry = retry or RetryPolicy()
+        self.error_counts = dict.fromkeys(RetryPolicy.LABELS, 0)  # 各类错误出现次数
+        self.recovered = 0  # 重试后成功的任务数
+        self.fragment_counts = dict.fromkeys(FragmentLedger.COUNTERS, 0)  # 分片续传/校验计数
+        self.concurrency = concurrency
+        self.bandwidth = bandwidth or BandwidthScheduler()
+        self.job_store = job_store
+        self.archive = archive
+        self.info_cache = info_cache
         self.max_workers = max_workers
+        self.postprocess_workers = postprocess_workers or os.cpu_count() or 2
+        self.stages = None
         self.executor = None
         self.tasks = []
-        self.current_futures = {}
+        self.by_url = {}  # 链接 -> 任务，展开播放列表时避免同一链接出现两个任务
+        self.queue = []  # 调度堆: (排序键, 序号, 任务)，过期条目出堆时跳过
+        self.queued_count = 0  # 堆里有效的条目数
+        self.seq = itertools.count()
         self.is_running = False
-        self.lock = threading.Lock()
-        
+        self.lock = threading.RLock()
+        self.progress = ProgressBus()
+        self.batch_lock = threading.Lock()
+        self.batch = [0, 0, 0, 0.0]  # 整批 已下载 / 总量 / 未知大小任务数 / 速度，按各任务的变化增量维护
+        self.sessions = SessionPool()
+        ChildProcesses.install()
+        FragmentLedger.install(listener.on_log)
+    
     def add_task(self, url, title=None):
         task = DownloadTask(url, title)
-        self.tasks.append(task)
+        if self.shortest_first and self.info_cache:
+            task.size = estimate_size(self.info_cache.get(url, count=False))
+        with self.lock:
+            self.tasks.append(task)
+            self.by_url[url] = task
+        self._account(task)
+        self.progress.add(task)
         return task
         
+    def add_urls(self, urls):
+        """批量添加任务 - 任务库中已完成 (且文件仍在) 的链接直接跳过，返回 (新建的任务, 跳过数量)
+        
+        下载进行中也可以调用，新任务直接进入调度队列。
+        """
+        jobs = self.job_store.lookup(urls) if self.job_store else {}
+        added = []
+        new_tasks = []
+        skipped = 0
+        for url in urls:
+            job = jobs.get(url)
+            if self._is_done(job):
+                skipped += 1
+                continue
+            task = self.add_task(url, job and job["title"])
+            if job and job["resolution"]:
+                task.resolution = job["resolution"]
+            added.append(url)
+            new_tasks.append(task)
+        if self.job_store:
+            self.job_store.add(added)
+        if self.is_running:
+            for task in new_tasks:
+                self._submit(task)
+        return new_tasks, skipped
+    
+    @staticmethod
+    def _is_done(job):
+        return bool(job and job["status"] == JobStore.DONE and (
+            not job["output_path"] or os.path.exists(job["output_path"])))
+    
+    def _add_entry(self, parent, url, title=None, enqueued=()):
+        """添加播放列表中的一个视频，已完成、已有任务或之前已经排过队的返回 None"""
+        if url in enqueued:
+            return None
+        job = self.job_store.lookup([url]).get(url) if self.job_store else None
+        if self._is_done(job):
+            return None
+        with self.lock:
+            # 重启后子视频作为未完成任务已经加入，或翻页出错重试时重新展开
+            if url in self.by_url:
+                return None
+            task = self.add_task(url, title or (job and job["title"]))
+        task.parent = parent
+        if self.job_store:
+            self.job_store.add([url], parent=parent.url)
+        self.listener.on_task_added(task)
+        return task
+    
+    def _save_job(self, task, **fields):
+        if self.job_store:
+            self.job_store.update(task.url, **fields)
+    
     def clear_tasks(self):
-        self.tasks = []
+        with self.lock:
+            self.tasks = []
+            self.by_url = {}
+        with self.batch_lock:
+            self.batch = [0, 0, 0, 0.0]
         
     def start(self, ydl_opts_base):
         if self.is_running:
             return
         self.is_running = True
-        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        # 自适应模式下线程数取上限，实际并发由 ConcurrencyController 控制
+        workers = self.concurrency.max_tasks if self.concurrency else self.max_workers
+        self.stages = PipelineStages(workers, self.postprocess_workers)
+        # 线程数 = 下载槽位 + 处理槽位，合并转码时不占下载线程
+        self.executor = ThreadPoolExecutor(max_workers=workers + self.postprocess_workers)
+        if self.archive:
+            ydl_opts_base['download_archive'] = self.archive
+        self.ydl_opts_base = ydl_opts_base
+        
+        # 先全部入队再启动执行，第一个开始的就是最优先的任务
+        pending = [task for task in list(self.tasks) if not task.completed and not task.cancelled]
+        for task in pending:
+            self._enqueue(task)
+        for _ in pending:
+            self.executor.submit(self._run_next)
+    
+    def _sort_key(self, task):
+        # 优先级高的在前；开启小文件优先时同优先级按大小，大小未知的排在后面
+        size = (task.size or float('inf')) if self.shortest_first else 0
+        return (-task.priority, size)
+    
+    def _enqueue(self, task):
+        with self.lock:
+            if task.queue_seq is None:
+                self.queued_count += 1
+            task.queued = True
+            task.queue_seq = next(self.seq)
+            heapq.heappush(self.queue, (self._sort_key(task), task.queue_seq, task))
+        self.metrics.phase(task, 'queue')
+    
+    def _submit(self, task):
+        """放进调度队列，并为它提交一次执行；线程空闲时取当时队列里最优先的任务，而不是提交顺序"""
+        self._enqueue(task)
+        self.executor.submit(self._run_next)
+    
+    def _withdraw(self, task):
+        """从调度队列撤下还没开始的任务 (堆里的条目留到出堆时跳过)"""
+        with self.lock:
+            if task.queue_seq is None:
+                return False
+            task.queue_seq = None
+            task.queued = False
+            self.queued_count -= 1
+            return True
+    
+    def _run_next(self):
+        # 先占下载槽位再出队，拿到槽位时取当时最优先的任务
+        if not self.stages.enter(PipelineStages.DOWNLOAD, lambda: not self.is_running):
+            return
+        with self.lock:
+            while self.queue:
+                _, seq, task = heapq.heappop(self.queue)
+                if seq == task.queue_seq:
+                    task.queue_seq = None
+                    self.queued_count -= 1
+                    task.thread = threading.get_ident()
+                    task.stage = PipelineStages.DOWNLOAD
+                    break
+            else:
+                self.stages.leave(PipelineStages.DOWNLOAD)
+                return  # 对应的任务已撤下或已换位
+        ydl_opts = self.ydl_opts_base.copy()
+        if task.parent:
+            # 播放列表已经展开，单个视频不再按列表处理
+            ydl_opts.pop('yes_playlist', None)
+            ydl_opts['noplaylist'] = True
+        self._download_task(task, ydl_opts)
+    
+    def _leave_stage(self, task):
+        if task.stage:
+            self.stages.leave(task.stage)
+            task.stage = None
+    
+    def gauges(self):
+        """导出指标时的瞬时值"""
+        depths = self.stages.depths(self.queued_count) if self.stages else {}
+        download = depths.get(PipelineStages.DOWNLOAD, {})
+        process = depths.get(PipelineStages.PROCESS, {})
+        return {
+            "queued_tasks": ("调度队列中等待的任务数", self.queued_count),
+            "downloading_tasks": ("占用下载槽位的任务数", download.get('active', 0)),
+            "processing_tasks": ("占用处理槽位的任务数", process.get('active', 0)),
+            "process_waiting_tasks": ("等待处理槽位的任务数", process.get('waiting', 0)),
+            "throughput_bytes_per_second": ("最近的总下载速度", round(self.bandwidth.throughput())),
+        }
+    
+    @staticmethod
+    def _batch_share(task):
+        """任务计入整批统计的 (已下载, 总量, 未知大小, 速度)
         
-        for task in self.tasks:
-            if not task.completed and not task.cancelled:
-                future = self.executor.submit(self._download_task, task, ydl_opts_base.copy())
-                self.current_futures[future] = task
+        已下载/总量按任务的实际字节，还没开始的任务用缓存信息里的预估大小；
+        不知道大小的任务记为未知，只有下载阶段的任务计入速度。
+        """
+        if task.skipped or task.cancelled or task.error:
+            return (0, 0, 0, 0.0)
+        done = task.downloaded_bytes
+        if task.completed:
+            return (done, done, 0, 0.0)
+        size = task.total_bytes or task.size
+        speed = task.speed if task.stage == PipelineStages.DOWNLOAD else 0.0
+        # 总量取整 (yt-dlp 的预估大小是浮点数)，反复增减时合计不会漂移
+        return (done, int(max(size, done)) if size else 0, 0 if size else 1, speed)
+    
+    def _account(self, task):
+        """把任务的变化按差值计入整批统计"""
+        share = self._batch_share(task)
+        with self.batch_lock:
+            old, task.batch_share = task.batch_share, share
+            for i, value in enumerate(share):
+                self.batch[i] += value - old[i]
+    
+    def _publish(self, task):
+        self._account(task)
+        self.progress.publish(task)
+    
+    def _finish(self, task):
+        self._account(task)
+        self.progress.finish(task)
+    
+    def batch_progress(self):
+        """整批的字节进度、速度和剩余时间 (读增量维护的合计，不遍历任务)
+        
+        完全不知道大小的任务数记在 unknown，剩余时间只覆盖已知部分。
+        """
+        with self.batch_lock:
+            done, total, unknown, speed = self.batch
+        speed = speed if speed >= 1 else 0.0  # 浮点反复增减留下的残差
+        eta = (total - done) / speed if speed and total > done else None
+        return {"downloaded_bytes": done, "total_bytes": total, "unknown": unknown,
+                "bytes_per_sec": speed, "eta": eta}
+    
+    def batch_text(self):
+        batch = self.batch_progress()
+        if not batch["total_bytes"]:
+            return ""
+        text = f"📊 {format_bytes(batch['downloaded_bytes'])}/{format_bytes(batch['total_bytes'])}"
+        if batch["unknown"]:
+            text += f" (+{batch['unknown']} 个未知大小)"
+        if batch["eta"] is not None:
+            text += f" 剩余 {format_eta(batch['eta'])}"
+        return text
+    
+    def stage_text(self):
+        return self.stages.status_text(self.queued_count) if self.stages else ""
+    
+    def set_priority(self, task, priority):
+        """修改优先级，还在排队的任务立即按新优先级重新排位"""
+        with self.lock:
+            task.priority = priority
+            if task.queue_seq is not None:
+                self._enqueue(task)
+    
+    def download_next(self, task):
+        """插队 - 排到所有等待中的任务前面 (已暂停的同时继续)"""
+        top = max((t.priority for t in self.tasks), default=0)
+        self.set_priority(task, top + 1)
+        self.resume_task(task)
+    
+    def _expand_playlist(self, task, info):
+        """把播放列表拆成单个视频任务，边翻页边提交，前面的视频不用等整个列表枚举完"""
+        task.title = f"📁 {info.get('title') or task.title}"
+        # 上次展开过的子视频会作为未完成任务自己继续，这里不再重复添加
+        enqueued = self.job_store.enqueued_children(task.url) if self.job_store else set()
+        count = 0
+        for entry in info.get('entries') or []:
+            if task.cancelled or not self.is_running:
+                raise Exception("用户取消")
+            if not entry:
+                continue
+            if entry.get('_type') in ('url', 'url_transparent'):
+                url = entry.get('url')
+            else:
+                url = entry.get('webpage_url') or entry.get('original_url') or entry.get('url')
+            if not url:
+                continue
+            
+            extractor = entry.get('ie_key') or entry.get('extractor_key')
+            if self.archive and extractor and entry.get('id'):
+                if yt_dlp.utils.make_archive_id(extractor, entry['id']) in self.archive:
+                    continue
+            if entry.get('formats') and self.info_cache:
+                # 列表里直接带了完整信息的视频，缓存起来省掉一次提取
+                self.info_cache.put(url, yt_dlp.YoutubeDL.sanitize_info(entry, remove_private_keys=True))
                 
+            child = self._add_entry(task, url, entry.get('title'), enqueued)
+            if child is None:
+                continue
+            count += 1
+            task.status = f"📁 展开中 {count} 个"
+            self._publish(task)
+            self._submit(child)
+        
+        task.status = f"📁 已展开 {count} 个视频"
+        task.progress = 100
+        task.completed = True
+        self._save_job(task, status=JobStore.DONE, title=task.title)
+    
+    
     def _download_task(self, task, ydl_opts):
+        domain = url_domain(task.url)
+        acquired = False
+        retry_delay = None
+        paused = False
+        error_msg = None
         try:
+            if task.paused or task.cancelled:
+                raise TaskInterrupted()
+            if self.concurrency:
+                fragments = self.concurrency.acquire(
+                    domain, lambda: task.cancelled or task.paused or not self.is_running)
+                if fragments is None:
+                    raise TaskInterrupted()
+                acquired = True
+                ydl_opts['concurrent_fragment_downloads'] = fragments
+            self.metrics.phase(task, 'extract')
+            
+            task.bytes_done = 0
+            task.downloaded_bytes = 0
+            task.total_bytes = None
+            task.speed = 0.0
+            task.eta = None
+            task.transfer_time = 0.0
+            task.fragments = 0
+            file_fragments = {}  # 文件名 -> 分片总数，下载完成时计入
             task.status = "下载中"
-            self.app.root.after(0, self.app.update_task_display)
+            self._publish(task)
+            self._save_job(task, status=JobStore.RUNNING)
+            
+            # 命中下载存档的链接不需要联网提取
+            archive_key = self.archive.key_for_url(task.url) if self.archive else None
+            if archive_key and archive_key in self.archive:
+                task.status = "⏭️ 已下载 (存档)"
+                task.progress = 100
+                task.completed = True
+                task.skipped = True
+                self._save_job(task, status=JobStore.DONE)
+                return
             
             def progress_hook(d):
-                if task.cancelled:
-                    raise Exception("用户取消")
+                if task.cancelled or task.paused:
+                    # 各分片线程都会走到这里，.part 文件保留，继续时从断点下载
+                    raise TaskInterrupted()
                 if d['status'] == 'downloading':
-                    try:
-                        percent_str = d.get('_percent_str', '0%').strip()
-                        task.progress = float(re.sub(r'[^\d.]', '', percent_str) or 0)
-                        task.speed = d.get('_speed_str', 'N/A').strip()
-                        task.eta = d.get('_eta_str', 'N/A').strip()
-                        
-                        # 获取分辨率信息
-                        info = d.get('info_dict', {})
-                        height = info.get('height', '')
-                        width = info.get('width', '')
-                        if height:
-                            task.resolution = f"{height}p"
-                        
-                        task.status = f"下载中 {task.progress:.1f}%"
-                        self.app.root.after(0, self.app.update_task_display)
-                    except:
-                        pass
+                    file_fragments[d.get('filename')] = d.get('fragment_count') or 0
+                    # 多个文件 (视频+音频) 的任务按已完成文件加当前文件累计
+                    downloaded = d.get('downloaded_bytes') or 0
+                    total = d.get('total_bytes') or d.get('total_bytes_estimate')
+                    task.downloaded_bytes = task.bytes_done + downloaded
+                    task.total_bytes = task.bytes_done + total if total else None
+                    if task.total_bytes:
+                        task.progress = min(100.0, task.downloaded_bytes * 100 / task.total_bytes)
+                    speed = d.get('speed')
+                    if speed is not None:
+                        task.speed = speed if not task.speed else task.speed + task.SPEED_ALPHA * (speed - task.speed)
+                    task.eta = (total - downloaded) / task.speed if total and task.speed else None
+                    
+                    # 获取分辨率信息
+                    height = (d.get('info_dict') or {}).get('height')
+                    if height:
+                        task.resolution = f"{height}p"
+                    
+                    task.status = f"下载中 {task.progress:.1f}%"
+                    self._publish(task)
+                    self.bandwidth.consume(task, d)
                 elif d['status'] == 'finished':
+                    task.fragments += file_fragments.pop(d.get('filename'), 0)
+                    task.bytes_done += d.get('total_bytes') or d.get('downloaded_bytes') or 0
+                    task.downloaded_bytes = task.bytes_done
+                    task.eta = None
+                    task.transfer_time += d.get('elapsed') or 0
                     task.status = "处理中..."
-                    self.app.root.after(0, self.app.update_task_display)
+                    self._publish(task)
+                    self.bandwidth.release(task)
+            
+            def release_transfer():
+                nonlocal acquired
+                if acquired:
+                    acquired = False
+                    self.concurrency.release(domain, task.bytes_done, task.transfer_time)
+            
+            def postprocessor_hook(d):
+                if d['status'] != 'started':
+                    return
+                if task.stage == PipelineStages.DOWNLOAD:
+                    # 字节已经落盘，让出下载槽位，合并/转码到处理阶段排队
+                    release_transfer()
+                    if d.get('postprocessor') == 'MoveFilesAfterDownload':
+                        self._leave_stage(task)
+                        return  # 只是移动文件，不占处理槽位
+                    self._enter_process_stage(task)
+                if task.stage == PipelineStages.PROCESS:
+                    task.status = f"⚙️ {d.get('postprocessor')}"
+                    self._publish(task)
             
             ydl_opts['progress_hooks'] = [progress_hook]
+            ydl_opts['postprocessor_hooks'] = [postprocessor_hook]
             
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                # 先获取信息
-                try:
-                    info = ydl.extract_info(task.url, download=False)
-                    if info:
-                        task.title = info.get('title', task.url[:50])
-                        # 获取最高分辨率
-                        formats = info.get('formats', [])
-                        video_formats = [f for f in formats if f.get('vcodec') != 'none' and f.get('height')]
-                        if video_formats:
-                            max_height = max(f.get('height', 0) for f in video_formats)
-                            task.resolution = f"最高{max_height}p"
-                        self.app.root.after(0, self.app.update_task_display)
-                except:
-                    pass
+            # 从会话池取实例，复用已加载的 Cookies 和连接
+            ydl = self.sessions.acquire(ydl_opts, domain)
+            try:
+                # 统计提取次数 (process_ie_result 内部的二次提取也会计入)
+                extract_info = ydl.extract_info
+                
+                def counted_extract_info(*args, **kwargs):
+                    task.extract_count += 1
+                    return extract_info(*args, **kwargs)
+                ydl.extract_info = counted_extract_info
+                
+                # 优先用缓存的信息 (如刚"获取信息"过)，否则只提取一次，不做格式处理
+                info = self.info_cache.get(task.url) if self.info_cache else None
+                if info is None:
+                    info = ydl.extract_info(task.url, download=False, process=False)
+                    if not info:
+                        raise Exception("无法获取视频信息")
+                    if self.info_cache:
+                        self.info_cache.put(task.url, ydl.sanitize_info(info, remove_private_keys=True))
+                
+                if info.get('_type') in ('playlist', 'multi_video'):
+                    self._expand_playlist(task, info)
+                    return
+                
+                summary = None
+                if info.get('_type', 'video') == 'video':
+                    # 先选定格式：下载前就确定是直接复制还是需要转码，也好尽早丢掉没选中的格式
+                    info = ydl.process_ie_result(info, download=False)
+                    summary = VideoSummary.from_info(info, task.url)
+                    drop_unselected_formats(info, keep_subtitles=bool(ydl.params.get('writesubtitles')))
+                    if self.container:
+                        task.plan, ext = plan_container(info, self.container, self.allow_transcode)
+                        with self.lock:
+                            self.plan_counts[task.plan] += 1
+                        if task.plan == 'fallback':
+                            self.listener.on_log(f"📦 {(info.get('title') or task.title)[:30]}: "
+                                                 f"没有能直接放进 {self.container} 的编码，保存为 {ext} (未转码)")
+                        elif task.plan == 'transcode':
+                            self.listener.on_log(f"🔄 {(info.get('title') or task.title)[:30]}: "
+                                                 f"需要转码为 {self.container}")
+                summary = summary or VideoSummary.from_info(info, task.url)
+                
+                task.title = summary.title or task.title
+                # 获取最高分辨率
+                if summary.best_height:
+                    task.resolution = f"最高{summary.best_height}p"
+                self._publish(task)
+                self._save_job(task, title=task.title, resolution=task.resolution, metadata=summary.metadata())
                 
-                # 下载
-                ydl.download([task.url])
+                # 复用提取结果直接下载，避免 ydl.download() 重新提取
+                self.metrics.phase(task, 'transfer')
+                result = ydl.process_ie_result(info, download=True)
+                downloads = (result or {}).get('requested_downloads') or []
+                if downloads:
+                    task.output_path = downloads[-1].get('filepath')
+                elif self.archive and info.get('id') and info.get('extractor_key'):
+                    # 提取后才识别出在存档里 (如通用提取器)，yt-dlp 已跳过下载
+                    task.skipped = yt_dlp.utils.make_archive_id(info['extractor_key'], info['id']) in self.archive
+            finally:
+                self.sessions.release(ydl, domain)
             
-            task.status = f"✅ 完成 {task.resolution}"
+            if self.audio_outputs and task.output_path and not task.skipped:
+                release_transfer()
+                self._transcode_audio(task, downloads[-1].get('acodec'))
+            
+            if task.skipped:
+                task.status = "⏭️ 已下载 (存档)"
+            else:
+                task.status = f"✅ 完成 {task.resolution}"
             task.progress = 100
             task.completed = True
+            if task.attempts:
+                with self.lock:
+                    self.recovered += 1
+            self._save_job(task, status=JobStore.DONE, output_path=task.output_path, error=None)
             
         except Exception as e:
             error_msg = str(e)
-            ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-            error_msg = ansi_escape.sub('', error_msg)
-            task.status = f"❌ 失败"
-            task.error = error_msg[:100]
-            self.app.log(f"❌ {task.title[:30]}: {error_msg[:150]}")
+            error_msg = ANSI_ESCAPE.sub('', error_msg)
+            if task.cancelled:
+                # 用户取消的任务保持未完成，下次启动可继续
+                task.status = "⏹️ 已取消"
+                task.error = "用户取消"
+                error_msg = None
+                self._save_job(task, status=JobStore.PENDING, error=None)
+            elif task.paused:
+                task.status = "⏸️ 已暂停"
+                task.speed = 0.0
+                error_msg = None
+                paused = True
+                self._save_job(task, status=JobStore.PENDING)
+            else:
+                task.error_class = self.retry.classify(error_msg)
+                with self.lock:
+                    self.error_counts[task.error_class] += 1
+                if self.is_running and self.retry.should_retry(task.error_class, task.attempts):
+                    task.attempts += 1
+                    retry_delay = self.retry.delay(task.attempts, self.retry.retry_after(e))
+                    if task.error_class == RetryPolicy.REEXTRACT and self.info_cache:
+                        self.info_cache.discard(task.url)
+                    task.status = f"🔁 {retry_delay:.0f}秒后重试 ({task.attempts}/{self.retry.max_retries})"
+                    task.progress = 0
+                    self.listener.on_log(f"🔁 {task.title[:30]}: [{RetryPolicy.LABELS[task.error_class]}] "
+                                         f"{error_msg[:150]} - {retry_delay:.0f} 秒后第 {task.attempts} 次重试")
+                    self._save_job(task, status=JobStore.PENDING, error=error_msg)
+                else:
+                    task.status = f"❌ 失败"
+                    task.error = error_msg
+                    self.listener.on_log(f"❌ {task.title[:30]}: {error_msg[:150]}")
+                    self._save_job(task, status=JobStore.FAILED, error=task.error)
             
         finally:
-            self.app.root.after(0, self.app.update_task_display)
-            self.app.root.after(0, self.app.check_all_completed)
+            if acquired:
+                self.concurrency.release(domain, task.bytes_done, task.transfer_time, error_msg)
+            self.bandwidth.release(task)
+            self._leave_stage(task)
+            with self.lock:
+                task.queued = False
+                task.thread = None
+                if paused and not task.paused and self.is_running:
+                    # 还没停下就又点了继续
+                    self._submit(task)
+            if retry_delay is not None:
+                outcome = 'retry'
+            elif paused:
+                outcome = 'paused'
+            elif task.completed:
+                outcome = 'skipped' if task.skipped else 'done'
+            else:
+                outcome = 'cancelled' if task.cancelled else 'failed'
+            self.metrics.finish(task, outcome)
+            fragment_stats = FragmentLedger.take_stats()
+            with self.lock:
+                for name, count in fragment_stats.items():
+                    self.fragment_counts[name] += count
+            if task.completed and (fragment_stats['reused'] or fragment_stats['repaired']):
+                self.listener.on_log(f"🧩 {task.title[:30]}: 续传复用 {fragment_stats['reused']} 个分片，"
+                                     f"新下载 {fragment_stats['fetched']} 个，校验后重下 {fragment_stats['repaired']} 个")
+            if retry_delay is not None:
+                # 到时间后排到队尾，不占用工作线程等待，其他链接照常下载
+                task.retry_timer = threading.Timer(retry_delay, self._resubmit, (task,))
+                task.retry_timer.daemon = True
+                task.retry_timer.start()
+            if paused or retry_delay is not None:
+                self._publish(task)
+                return
+            self._finish(task)
+            if self.progress.done() >= self.progress.total:
+                if self.job_store:
+                    self.job_store.flush()
+                self.sessions.close()
+            self.listener.on_task_finished(task)
             
-    def cancel_all(self):
-        for task in self.tasks:
+    def _enter_process_stage(self, task):
+        """让出下载槽位，到处理阶段排队"""
+        self._leave_stage(task)
+        task.status = "⏳ 等待处理"
+        self._publish(task)
+        self.metrics.phase(task, 'process_wait')
+        if not self.stages.enter(PipelineStages.PROCESS, lambda: task.cancelled or task.paused):
+            raise TaskInterrupted()
+        task.stage = PipelineStages.PROCESS
+        self.metrics.phase(task, 'process')
+    
+    def _transcode_audio(self, task, acodec):
+        """音频模式：下载完成后在处理阶段转成所有要求的格式，ffmpeg 进程由转码池按核数调度"""
+        if not self.transcoder:
+            # 没有 FFmpeg 时只有下载的就是要的格式才能直接用
+            fmt, _ = self.audio_outputs[0]
+            if len(self.audio_outputs) == 1 and AudioTranscoder.matches(fmt, acodec):
+                return
+            raise Exception("需要 FFmpeg 才能转换音频格式")
+        if task.stage != PipelineStages.PROCESS:
+            self._enter_process_stage(task)
+        task.status = f"🎵 转码中 ({len(self.audio_outputs)} 个输出)"
+        self._publish(task)
+        outputs = self.transcoder.transcode(task.output_path, acodec, self.audio_outputs, owner=task.thread,
+                                               interrupted=lambda: task.paused or task.cancelled)
+        task.output_path = outputs[0]
+    
+    def transcode_summary(self):
+        return self.transcoder.summary() if self.transcoder else ""
+    
+    def _resubmit(self, task):
+        with self.lock:
+            task.retry_timer = None
+            if not self.is_running or task.cancelled or task.paused or task.queued:
+                return
+            # 降低优先级重新排队，正常的链接先下
+            task.priority -= 1
+            task.status = "等待中 (重试)"
+            try:
+                self._submit(task)
+            except RuntimeError:
+                return  # 线程池已关闭
+        self._publish(task)
+    
+    def pause_task(self, task):
+        """暂停任务 - 排队中的直接撤下，下载中的在下一次进度回调时停下，保留 .part 文件"""
+        with self.lock:
+            if task.completed or task.cancelled or task.paused or task.error:
+                return False
+            task.paused = True
+            if self._withdraw(task):
+                self.metrics.finish(task, 'paused')
+            if task.retry_timer:
+                task.retry_timer.cancel()
+                task.retry_timer = None
+            thread = task.thread
+        if thread:
+            ChildProcesses.kill(thread)
+        task.status = "⏸️ 已暂停"
+        task.speed = 0.0
+        self._publish(task)
+        return True
+    
+    def resume_task(self, task):
+        with self.lock:
+            if not task.paused or task.cancelled:
+                return False
+            task.paused = False
+            if not task.queued and self.is_running:
+                task.status = "等待中"
+                self._submit(task)
+        self._publish(task)
+        return True
+    
+    def cancel_task(self, task):
+        """取消单个任务 - 停止下载和 ffmpeg，已下载部分保留，下次启动可继续"""
+        with self.lock:
+            if task.completed or task.cancelled or task.error:
+                return False
             task.cancelled = True
-        if self.executor:
-            self.executor.shutdown(wait=False)
+            idle = not task.queued or self._withdraw(task)
+            if task.retry_timer:
+                task.retry_timer.cancel()
+                task.retry_timer = None
+            thread = task.thread
+        if thread:
+            ChildProcesses.kill(thread)
+        if idle:
+            # 没有线程在执行，直接在这里结束
+            task.status = "⏹️ 已取消"
+            task.error = "用户取消"
+            self._save_job(task, status=JobStore.PENDING, error=None)
+            self.metrics.finish(task, 'cancelled')
+            self._finish(task)
+            self.listener.on_task_finished(task)
+        return True
+    
+    def pause_all(self):
+        return sum(1 for task in list(self.tasks) if self.pause_task(task))
+    
+    def resume_all(self):
+        return sum(1 for task in list(self.tasks) if self.resume_task(task))
+    
+    def plan_summary(self):
+        """各封装方式的任务数，没有规划过时返回空字符串"""
+        return " | ".join(f"{PLAN_LABELS[plan]} {count}" for plan, count in self.plan_counts.items() if count)
+    
+    def fragment_summary(self):
+        """分片续传和校验的计数，没有分片下载时返回空字符串"""
+        counts = self.fragment_counts
+        if not any(counts.values()):
+            return ""
+        return f"新下载 {counts['fetched']} | 续传复用 {counts['reused']} | 校验后重下 {counts['repaired']}"
+    
+    def retry_summary(self):
+        """各类错误次数，没有出错时返回空字符串"""
+        if not any(self.error_counts.values()):
+            return ""
+        counts = " | ".join(f"{label} {self.error_counts[cls]}" for cls, label in RetryPolicy.LABELS.items())
+        return f"{counts} | 重试后成功 {self.recovered}"
+    
+    def cancel_all(self):
         self.is_running = False
+        # 排队中和空闲的任务在 cancel_task 里直接结束 (记任务库、指标、完成计数)
+        for task in list(self.tasks):
+            self.cancel_task(task)
+        # 结束 ffmpeg 等子进程，下载中的任务在下一次进度回调时停下
+        ChildProcesses.kill()
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        if self.job_store:
+            self.job_store.flush()
         
     def shutdown(self):
         self.is_running = False
         if self.executor:
             self.executor.shutdown(wait=False)
+        if self.transcoder:
+            self.transcoder.close()
+        self.sessions.close()
+
+
+class SessionPool:
+    """YoutubeDL 会话池 - 按 (代理, Cookies 来源) 分组，实例用完放回，供后面的任务接着用
+    
+    同一组只加载一次 cookiejar (浏览器 Cookies 每批只解密一次)，所有实例共用；
+    取实例时优先拿上次访问过同一站点的，沿用它的 keep-alive 连接，省去重新建连和 TLS 握手。
+    同一时间一个实例只给一个线程用，每个任务不同的参数在取出时写入 params。
+    """
+    TASK_KEYS = ('noplaylist', 'yes_playlist', 'concurrent_fragment_downloads')
+    HOOK_KEYS = ('progress_hooks', 'postprocessor_hooks')
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.groups = {}  # (代理, Cookies 来源) -> {"cookiejar": ..., "idle": [(站点, 实例)]}
+        self.hooks = {}  # id(实例) -> 当前任务的 {'progress_hooks': [...], 'postprocessor_hooks': [...]}
+        self.instances = []
+        self.created = 0
+        self.reused = 0
+    
+    @staticmethod
+    def key_for(opts):
+        browser = opts.get('cookiesfrombrowser')
+        return (opts.get('proxy'), tuple(browser) if browser else None, opts.get('cookiefile'))
+    
+    def _create(self, opts, group):
+        base = {k: v for k, v in opts.items() if k not in self.HOOK_KEYS}
+        ydl = yt_dlp.YoutubeDL(base)
+        ydl.add_progress_hook(lambda d: self._dispatch(ydl, 'progress_hooks', d))
+        ydl.add_postprocessor_hook(lambda d: self._dispatch(ydl, 'postprocessor_hooks', d))
+        with self.lock:
+            jar = group["cookiejar"]
+        if jar is None:
+            jar = ydl.cookiejar  # 第一次用到时加载 (浏览器 Cookies 在这里解密)
+            with self.lock:
+                if group["cookiejar"] is None:
+                    group["cookiejar"] = jar
+                jar = group["cookiejar"]
+        ydl.__dict__['cookiejar'] = jar
+        with self.lock:
+            self.instances.append(ydl)
+            self.created += 1
+        return ydl
+    
+    def _dispatch(self, ydl, kind, d):
+        for hook in self.hooks.get(id(ydl), {}).get(kind, ()):
+            hook(d)
+    
+    def acquire(self, opts, domain=None):
+        """取一个空闲实例 (没有就新建)，按 opts 设置本任务的参数和进度回调"""
+        key = self.key_for(opts)
+        ydl = None
+        with self.lock:
+            group = self.groups.setdefault(key, {"cookiejar": None, "idle": []})
+            idle = group["idle"]
+            if idle:
+                index = next((i for i, (d, _) in enumerate(idle) if d == domain), len(idle) - 1)
+                ydl = idle.pop(index)[1]
+                self.reused += 1
+        if ydl is None:
+            ydl = self._create(opts, group)
+        for name in self.TASK_KEYS:
+            if name in opts:
+                ydl.params[name] = opts[name]
+            else:
+                ydl.params.pop(name, None)
+        self.hooks[id(ydl)] = {kind: list(opts.get(kind) or []) for kind in self.HOOK_KEYS}
+        ydl._session_key = key
+        return ydl
+    
+    def release(self, ydl, domain=None):
+        self.hooks.pop(id(ydl), None)
+        ydl.__dict__.pop('extract_info', None)  # 去掉任务里临时包装的方法
+        with self.lock:
+            group = self.groups.get(ydl._session_key)
+            if group is not None:
+                group["idle"].append((domain, ydl))
+    
+    def close(self):
+        """关闭所有实例 (保存 Cookies、断开连接)，之后再取会重新创建"""
+        with self.lock:
+            instances, self.instances = self.instances, []
+            self.groups = {}
+        for ydl in instances:
+            try:
+                ydl.close()
+            except Exception:
+                pass
+    
+    def stats_text(self):
+        return f"会话 新建 {self.created} / 复用 {self.reused}"
+
+
+class InfoProber:
+    """批量获取视频信息 - 多个链接并发提取，按完成顺序回调
+    
+    YoutubeDL 实例放在池里复用 (同一时间只给一个线程用)，每个站点单独限制并发数。
+    播放列表只平铺枚举 (不逐个提取里面的视频)，回调拿到的是 VideoSummary 而不是完整 info。
+    """
+    
+    def __init__(self, ydl_opts, max_workers=8, per_domain=3, cache=None):
+        self.ydl_opts = {**ydl_opts, 'extract_flat': 'in_playlist'}
+        self.cache = cache
+        self.max_workers = max_workers
+        self.per_domain = per_domain
+        self.sessions = SessionPool()
+        self.domain_slots = {}
+        self.lock = threading.Lock()
+        self.cancelled = False
+    
+    def _domain_slot(self, url):
+        domain = url_domain(url)
+        with self.lock:
+            if domain not in self.domain_slots:
+                self.domain_slots[domain] = threading.BoundedSemaphore(self.per_domain)
+            return self.domain_slots[domain]
+    
+    def _probe_one(self, url):
+        if self.cancelled:
+            return url, None, None
+        info = self.cache.get(url) if self.cache else None
+        if info:
+            return url, VideoSummary.from_info(info, url), None
+        with self._domain_slot(url):
+            if self.cancelled:
+                return url, None, None
+            domain = url_domain(url)
+            ydl = self.sessions.acquire(self.ydl_opts, domain)
+            try:
+                info = ydl.extract_info(url, download=False)
+                if not info:
+                    return url, None, "无法获取视频信息"
+                if self.cache:
+                    self.cache.put(url, ydl.sanitize_info(info, remove_private_keys=True))
+                return url, VideoSummary.from_info(info, url), None
+            except Exception as e:
+                return url, None, str(e)
+            finally:
+                self.sessions.release(ydl, domain)
+    
+    def interleave(self, urls):
+        """按站点轮流排列，避免同一站点的链接占满所有线程后排队等待"""
+        groups = {}
+        for url in urls:
+            groups.setdefault(url_domain(url), []).append(url)
+        ordered = []
+        for i in range(max((len(g) for g in groups.values()), default=0)):
+            ordered.extend(g[i] for g in groups.values() if i < len(g))
+        return ordered
+    
+    def probe(self, urls, on_result):
+        """并发提取所有链接，每完成一个调用 on_result(url, summary, error)，返回完成数量"""
+        done = 0
+        futures = []
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = [executor.submit(self._probe_one, url) for url in self.interleave(urls)]
+            for future in as_completed(futures):
+                if self.cancelled:
+                    break
+                url, info, error = future.result()
+                if info or error:
+                    done += 1
+                    on_result(url, info, error)
+        finally:
+            if self.cancelled:
+                for future in futures:
+                    future.cancel()
+            executor.shutdown(wait=False)
+            if not self.cancelled:
+                self.sessions.close()
+        return done
+    
+    def cancel(self):
+        self.cancelled = True
+
+
+# 下载选项默认值 (与界面默认选项一致)
+DEFAULT_DOWNLOAD_OPTIONS = {
+    "download_type": "video_audio",
+    "quality": "best",
+    "audio_format": "mp3",
+    "audio_quality": "0",
+    "use_cookies": True,
+    "use_proxy": True,
+    "download_playlist": True,
+    "embed_subs": False,
+    "keep_original": False,
+    "container": "mkv",  # 合并输出容器: mkv / mp4 / webm
+    "allow_transcode": False,  # 目标容器放不下所选编码时是否允许转码
+    "audio_extra": "",  # 额外的音频输出，如 "opus:128, flac"
+}
+
+# 各容器能直接复制 (不转码) 的编码，与 yt-dlp 合并时的兼容表一致
+CONTAINER_CODECS = {
+    "mp4": (r"^(avc1|h264|av01)", r"^(mp4a|ec-3|ac-4)"),
+    "webm": (r"^(vp0?8|vp0?9|av01)", r"^(opus|vorbis)"),
+}
+PLAN_LABELS = {
+    "copy": "直接保存",
+    "remux": "直接复制流",
+    "transcode": "转码",
+    "fallback": "改用其他容器",
+}
+
+
+def container_for(options):
+    """下载选项对应的目标容器 (mkv / mp4 / webm / original)，仅音频时返回 None"""
+    if options["download_type"] == "audio_only":
+        return None
+    if options["keep_original"]:
+        return "original"
+    return options.get("container") or "mkv"
+
+
+def plan_container(info, container, allow_transcode=False):
+    """判断选好格式的视频怎样放进目标容器，返回 (方式, 最终扩展名)
+    
+    方式见 PLAN_LABELS: copy 单文件原样保存 / remux 合并时直接复制流 /
+    transcode 需要重新编码 / fallback 目标容器放不下这些编码，换容器保存以免转码。
+    """
+    requested = info.get('requested_formats')
+    if not requested:
+        ext = info.get('ext') or '?'
+        if container in ('mkv', 'original') or ext == container:
+            return 'copy', ext
+        return ('transcode', container) if allow_transcode else ('fallback', ext)
+    if container == 'original':
+        return 'remux', info.get('ext') or '?'
+    video = [f for f in requested if f.get('vcodec') != 'none']
+    audio = [f for f in requested if f.get('acodec') != 'none']
+    ext = yt_dlp.utils.get_compatible_ext(
+        vcodecs=[f.get('vcodec') for f in video], acodecs=[f.get('acodec') for f in audio],
+        vexts=[f.get('ext') for f in video], aexts=[f.get('ext') for f in audio],
+        preferences=(container, 'mkv'))
+    if ext == container:
+        return 'remux', ext
+    return ('transcode', container) if allow_transcode else ('fallback', ext)
+
+
+def build_ydl_opts(config, ffmpeg_manager, options, for_info_only=False):
+    """获取 yt-dlp 配置 - 完全修复最高画质下载
+    
+    options 为下载选项字典 (见 DEFAULT_DOWNLOAD_OPTIONS)，GUI 和命令行共用。
+    """
+    download_path = options["download_path"]
+    download_type = options["download_type"]
+    quality = options["quality"]
+    
+    opts = {
+        'quiet': True,
+        'no_warnings': True,
+        # 下载时错误直接抛出，交给 RetryPolicy 分类重试；获取信息时忽略播放列表中个别失败的视频
+        'ignoreerrors': for_info_only,
+        'nocheckcertificate': True,
+        # 保留 .part 文件，暂停或中断后继续时从断点接着下载
+        'continuedl': True,
+        'outtmpl': os.path.join(download_path, '%(title)s.%(ext)s'),
+        # 多线程下载分片
+        'concurrent_fragment_downloads': config.get("thread_count", 8),
+        # 🔑 关键：允许不安全的扩展名（某些高分辨率格式需要）
+        'allow_unplayable_formats': False,
+    }
+    
+    # 播放列表设置
+    if not options["download_playlist"]:
+        opts['noplaylist'] = True
+    else:
+        opts['yes_playlist'] = True
+    
+    # Cookies - 4K视频通常需要
+    if options["use_cookies"]:
+        cookies_file = config.get("cookies_file", "")
+        cookies_browser = config.get("cookies_browser", "")
+        if cookies_file and os.path.exists(cookies_file):
+            opts['cookiefile'] = cookies_file
+        elif cookies_browser:
+            opts['cookiesfrombrowser'] = (cookies_browser,)
+    
+    # 代理
+    if options["use_proxy"]:
+        proxy = fix_proxy_protocol(config.get("proxy", ""))
+        if proxy:
+            opts['proxy'] = proxy
+    
+    # FFmpeg
+    ffmpeg_location = ffmpeg_manager.get_ffmpeg_location()
+    if ffmpeg_location:
+        opts['ffmpeg_location'] = ffmpeg_location
+    
+    # ========== 🔥 核心修复：格式选择 ==========
+    if download_type == "audio_only":
+        # 选择最佳音频；格式转换由 AudioTranscoder 在处理阶段并行完成
+        # 有和主格式同编码的音轨时优先下载它，可以直接复制不重新编码
+        audio_fmt = options["audio_format"].split(",")[0].strip()
+        source = AudioTranscoder.SOURCE_CODECS.get(audio_fmt)
+        preferred = f"ba[acodec~='{source}']/" if source else ""
+        opts['format'] = f'{preferred}bestaudio/best'
+    
+    elif download_type == "video_only":
+        if quality == "best":
+            # 🔑 使用 bv* 获取所有视频格式中的最佳
+            opts['format'] = 'bv*[vcodec!^=none]/bv*/best'
+            # 强制按分辨率排序，最高优先
+            opts['format_sort'] = ['res:4320', 'res']  # 最高支持8K
+        else:
+            opts['format'] = f'bv*[height<={quality}]/bv*/best[height<={quality}]/best'
+    
+    else:  # video_audio - 最常用
+        if quality == "best":
+            # 🔑🔑🔑 关键修复：获取绝对最高画质
+            # bv* = 最佳视频（包括所有编码格式）
+            # ba = 最佳音频
+            # /b = 备选：合并格式
+            opts['format'] = 'bv*+ba/b'
+            
+            # 🔥 强制格式排序 - 分辨率最优先
+            opts['format_sort'] = [
+                'res:4320',     # 优先8K
+                'res:2160',     # 然后4K
+                'res:1440',     # 然后2K
+                'res',          # 然后按分辨率排序
+                'vcodec:vp9.2', # VP9 Profile 2 (HDR)
+                'vcodec:vp9',   # VP9
+                'vcodec:av01',  # AV1
+                'vcodec:avc',   # H.264
+                'acodec:opus',  # Opus音频
+                'acodec:aac',   # AAC音频
+            ]
+            
+            # 🔑 强制使用我们的排序规则
+            opts['format_sort_force'] = True
+        
+        else:
+            # 指定分辨率
+            opts['format'] = f'bv*[height<={quality}]+ba/b[height<={quality}]/b'
+            opts['format_sort'] = ['res', 'vcodec:vp9', 'acodec:opus']
+        
+    # 输出容器 - 只选能直接复制进目标容器的编码，合并时不转码
+    container = container_for(options)
+    if container in CONTAINER_CODECS:
+        vcodecs, acodecs = CONTAINER_CODECS[container]
+        height = '' if quality == 'best' else f'[height<={quality}]'
+        if download_type == "video_only":
+            preferred = f"bv*[vcodec~='{vcodecs}']{height}/"
+        else:
+            preferred = (f"bv*[vcodec~='{vcodecs}']{height}+ba[acodec~='{acodecs}']/"
+                         f"b[vcodec~='{vcodecs}'][acodec~='{acodecs}']{height}/")
+        opts['format'] = preferred + opts['format']
+        # 没有兼容的组合时合并成 mkv，不会悄悄转码
+        opts['merge_output_format'] = f'{container}/mkv'
+        if options.get("allow_transcode"):
+            # 已经是目标格式时 yt-dlp 会跳过转换，只在确实放不下时转码
+            opts.setdefault('postprocessors', []).append({
+                'key': 'FFmpegVideoConvertor',
+                'preferedformat': container,
+            })
+    elif container == "mkv":
+        # mkv 兼容性最好，支持几乎所有编码
+        opts['merge_output_format'] = 'mkv'
+    # original: 保持原始格式，不设置 merge_output_format
+    
+    # 字幕
+    if options["embed_subs"]:
+        opts['writesubtitles'] = True
+        opts['writeautomaticsub'] = True
+        opts['subtitleslangs'] = ['zh', 'en', 'zh-Hans', 'zh-Hant', 'ja', 'ko']
+        opts.setdefault('postprocessors', []).append({
+            'key': 'FFmpegEmbedSubtitle',
+        })
+    
+    return opts
 
 
 class SettingsWindow:
@@ -353,7 +3180,15 @@ class SettingsWindow:
         self.ffmpeg_path_var.set(self.config.get("ffmpeg_path", ""))
         self.concurrent_var.set(self.config.get("max_concurrent", 3))
         self.thread_var.set(self.config.get("thread_count", 8))
+        self.refresh_var.set(self.config.get("ui_refresh_hz", 10))
+        self.log_lines_var.set(self.config.get("log_max_lines", 5000))
+        self.retry_var.set(self.config.get("max_retries", 3))
+        self.bandwidth_var.set(self.config.get("bandwidth_limit_mb", 0))
+        self.bandwidth_fair_var.set(self.config.get("bandwidth_fair", True))
+        self.adaptive_var.set(self.config.get("adaptive_concurrency", False))
         self.prefer_free_var.set(self.config.get("prefer_free_formats", False))
+        self.shortest_first_var.set(self.config.get("shortest_first", False))
+        self.archive_var.set(self.config.get("use_archive", False))
         self.update_ffmpeg_status()
         
     def create_widgets(self):
@@ -439,6 +3274,10 @@ class SettingsWindow:
                    width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
         ttk.Label(concurrent_inner, text="(建议 1-5)").pack(side=tk.LEFT)
         
+        self.shortest_first_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(concurrent_frame, text="小文件优先 (按已获取信息中的文件大小排队，缩短平均等待)", 
+                       variable=self.shortest_first_var).pack(anchor=tk.W, pady=(5, 0))
+        
         # 线程数
         thread_frame = ttk.LabelFrame(download_frame, text="单视频下载线程", padding="10")
         thread_frame.pack(fill=tk.X, pady=10)
@@ -452,6 +3291,60 @@ class SettingsWindow:
                    width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
         ttk.Label(thread_inner, text="(建议 4-16)").pack(side=tk.LEFT)
         
+        self.adaptive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(thread_frame, text="自适应并发 (按站点吞吐自动增减同时下载数和线程数，以上数值作为起点)", 
+                       variable=self.adaptive_var).pack(anchor=tk.W, pady=(5, 0))
+        
+        # 总带宽
+        bandwidth_frame = ttk.LabelFrame(download_frame, text="总带宽上限", padding="10")
+        bandwidth_frame.pack(fill=tk.X, pady=5)
+        
+        self.bandwidth_var = tk.DoubleVar(value=0)
+        self.bandwidth_fair_var = tk.BooleanVar(value=True)
+        bandwidth_inner = ttk.Frame(bandwidth_frame)
+        bandwidth_inner.pack(fill=tk.X)
+        
+        ttk.Label(bandwidth_inner, text="所有下载合计 (MB/s):").pack(side=tk.LEFT)
+        ttk.Spinbox(bandwidth_inner, from_=0, to=1000, increment=0.5, textvariable=self.bandwidth_var,
+                   width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
+        ttk.Label(bandwidth_inner, text="(0 = 不限，保存后立即生效)").pack(side=tk.LEFT)
+        ttk.Checkbutton(bandwidth_frame, text="各任务平分带宽", 
+                       variable=self.bandwidth_fair_var).pack(anchor=tk.W, pady=(5, 0))
+        
+        # 界面刷新频率
+        refresh_frame = ttk.LabelFrame(download_frame, text="界面刷新", padding="10")
+        refresh_frame.pack(fill=tk.X, pady=5)
+        
+        self.refresh_var = tk.IntVar(value=10)
+        refresh_inner = ttk.Frame(refresh_frame)
+        refresh_inner.pack(fill=tk.X)
+        
+        ttk.Label(refresh_inner, text="进度刷新频率 (Hz):").pack(side=tk.LEFT)
+        ttk.Spinbox(refresh_inner, from_=1, to=30, textvariable=self.refresh_var,
+                   width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
+        ttk.Label(refresh_inner, text="(批量很大时可调低)").pack(side=tk.LEFT)
+        
+        self.log_lines_var = tk.IntVar(value=5000)
+        log_inner = ttk.Frame(refresh_frame)
+        log_inner.pack(fill=tk.X, pady=(5, 0))
+        ttk.Label(log_inner, text="日志保留行数:").pack(side=tk.LEFT)
+        ttk.Spinbox(log_inner, from_=100, to=100000, increment=1000, textvariable=self.log_lines_var,
+                   width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
+        ttk.Label(log_inner, text="(完整日志保存在配置目录 logs 下)").pack(side=tk.LEFT)
+        
+        # 失败重试
+        retry_frame = ttk.LabelFrame(download_frame, text="失败重试", padding="10")
+        retry_frame.pack(fill=tk.X, pady=5)
+        
+        self.retry_var = tk.IntVar(value=3)
+        retry_inner = ttk.Frame(retry_frame)
+        retry_inner.pack(fill=tk.X)
+        
+        ttk.Label(retry_inner, text="临时错误重试次数:").pack(side=tk.LEFT)
+        ttk.Spinbox(retry_inner, from_=0, to=10, textvariable=self.retry_var,
+                   width=10, font=('Consolas', 12)).pack(side=tk.LEFT, padx=10)
+        ttk.Label(retry_inner, text="(429/5xx/超时/链接过期，404 等不重试)").pack(side=tk.LEFT)
+        
         # 格式偏好
         format_frame = ttk.LabelFrame(download_frame, text="格式偏好", padding="10")
         format_frame.pack(fill=tk.X, pady=10)
@@ -460,6 +3353,14 @@ class SettingsWindow:
         ttk.Checkbutton(format_frame, text="优先免费/开放格式 (VP9/AV1/Opus)", 
                        variable=self.prefer_free_var).pack(anchor=tk.W)
         
+        # 下载存档
+        archive_frame = ttk.LabelFrame(download_frame, text="下载存档", padding="10")
+        archive_frame.pack(fill=tk.X, pady=5)
+        
+        self.archive_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(archive_frame, text="跳过已下载过的视频 (按网站+视频ID记录)", 
+                       variable=self.archive_var).pack(anchor=tk.W)
+        
         tk.Label(download_frame, 
                 text="💡 分片线程: 加速单个视频下载\n💡 同时下载数: 同时下载多个视频\n💡 4K视频通常是VP9/AV1编码，需要FFmpeg",
                 justify=tk.LEFT, font=('微软雅黑', 9), fg='#888888', bg='#2b2b2b').pack(anchor=tk.W, pady=10)
@@ -548,7 +3449,15 @@ class SettingsWindow:
                 "ffmpeg_path": self.ffmpeg_path_var.get().strip(),
                 "max_concurrent": self.concurrent_var.get(),
                 "thread_count": self.thread_var.get(),
+                "ui_refresh_hz": self.refresh_var.get(),
+                "log_max_lines": self.log_lines_var.get(),
+                "max_retries": self.retry_var.get(),
+                "bandwidth_limit_mb": self.bandwidth_var.get(),
+                "bandwidth_fair": self.bandwidth_fair_var.get(),
+                "adaptive_concurrency": self.adaptive_var.get(),
                 "prefer_free_formats": self.prefer_free_var.get(),
+                "use_archive": self.archive_var.get(),
+                "shortest_first": self.shortest_first_var.get(),
             }
             
             if self.config.set_multiple(settings):
@@ -566,7 +3475,7 @@ class SettingsWindow:
         self.window.destroy()
 
 
-class VideoDownloaderApp:
+class VideoDownloaderApp(DownloadListener):
     def __init__(self, root):
         self.root = root
         self.root.title("🎬 多平台视频下载器 v2.0 - 支持4K/8K")
@@ -574,15 +3483,28 @@ class VideoDownloaderApp:
         self.root.configure(bg='#2b2b2b')
         
         self.config = ConfigManager()
-        self.ffmpeg_manager = FFmpegManager(self.config)
+        self.logs = open_log_buffer(self.config)
+        # 先用缓存的检测结果显示窗口，后台校验完有变化再刷新
+        self.ffmpeg_manager = FFmpegManager(self.config, background=True)
+        self.job_store = open_job_store(self.config)
+        self.archive = None
+        self.info_cache = open_info_cache(self.config)
+        self.bandwidth = BandwidthScheduler(self.config.get("bandwidth_limit_mb", 0) * 1024 * 1024,
+                                            fair=self.config.get("bandwidth_fair", True))
         self.download_manager = None
+        self.metrics = None
+        self.prober = None
         
         self.setup_styles()
         self.create_widgets()
         
         self.is_downloading = False
+        self.batch_paused = False
         self.update_status_display()
         self.show_config_status()
+        # 查询任务库放到窗口显示之后
+        self.root.after_idle(self.show_unfinished_jobs)
+        self.flush_progress()
         
     def show_config_status(self):
         self.log(f"📁 配置: {self.config.config_file}")
@@ -599,6 +3521,15 @@ class VideoDownloaderApp:
         self.log("💡 选择'原始最高'获取视频最高可用画质")
         self.log("=" * 60)
         
+    def show_unfinished_jobs(self):
+        """上次未完成的任务自动填回链接框"""
+        if not self.job_store:
+            return
+        urls = self.job_store.unfinished()
+        if urls:
+            self.url_text.insert(tk.END, '\n'.join(urls) + '\n')
+            self.log(f"♻️ 上次有 {len(urls)} 个未完成任务，已填入链接框，点击开始下载即可继续")
+    
     def setup_styles(self):
         style = ttk.Style()
         style.theme_use('clam')
@@ -703,6 +3634,10 @@ class VideoDownloaderApp:
         for text, value in [("最高", "0"), ("320k", "320"), ("256k", "256"), ("192k", "192")]:
             ttk.Radiobutton(qual_frame, text=text, variable=self.audio_quality, value=value).pack(side=tk.LEFT, padx=3)
         
+        ttk.Label(self.audio_frame, text="额外输出 (如 opus:128, flac):").pack(anchor=tk.W, pady=(5, 0))
+        self.audio_extra = tk.StringVar()
+        ttk.Entry(self.audio_frame, textvariable=self.audio_extra, width=24).pack(anchor=tk.W)
+        
         # 高级选项
         adv_frame = ttk.LabelFrame(options_frame, text="🔧 选项", padding="8")
         adv_frame.pack(side=tk.LEFT, fill=tk.Y, padx=5)
@@ -719,6 +3654,15 @@ class VideoDownloaderApp:
         ttk.Checkbutton(adv_frame, text="嵌入字幕", variable=self.embed_subs).pack(anchor=tk.W)
         ttk.Checkbutton(adv_frame, text="保持原始格式", variable=self.keep_original).pack(anchor=tk.W)
         
+        container_row = ttk.Frame(adv_frame)
+        container_row.pack(anchor=tk.W, pady=(3, 0))
+        ttk.Label(container_row, text="容器:").pack(side=tk.LEFT)
+        self.container_var = tk.StringVar(value="mkv")
+        ttk.Combobox(container_row, textvariable=self.container_var, values=["mkv", "mp4", "webm"],
+                     state='readonly', width=6).pack(side=tk.LEFT, padx=3)
+        self.allow_transcode = tk.BooleanVar(value=False)
+        ttk.Checkbutton(adv_frame, text="允许转码 (较慢)", variable=self.allow_transcode).pack(anchor=tk.W)
+        
         # ==================== 保存路径 ====================
         path_frame = ttk.LabelFrame(main_frame, text="📁 保存位置", padding="8")
         path_frame.pack(fill=tk.X, pady=5)
@@ -740,6 +3684,9 @@ class VideoDownloaderApp:
         self.cancel_btn = ttk.Button(action_frame, text="⏹️ 取消全部", command=self.cancel_download, width=12, state='disabled')
         self.cancel_btn.pack(side=tk.LEFT, padx=5)
         
+        self.pause_btn = ttk.Button(action_frame, text="⏸️ 暂停全部", command=self.toggle_pause, width=12, state='disabled')
+        self.pause_btn.pack(side=tk.LEFT, padx=5)
+        
         # 统计信息
         self.stats_label = ttk.Label(action_frame, text="")
         self.stats_label.pack(side=tk.RIGHT, padx=10)
@@ -769,6 +3716,17 @@ class VideoDownloaderApp:
         self.task_tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         task_scroll.pack(side=tk.RIGHT, fill=tk.Y)
         
+        # 右键菜单 - 单个任务暂停/继续/取消
+        self.task_menu = tk.Menu(self.root, tearoff=0)
+        self.task_menu.add_command(label="⏸️ 暂停", command=lambda: self.apply_to_selected("pause_task"))
+        self.task_menu.add_command(label="▶️ 继续", command=lambda: self.apply_to_selected("resume_task"))
+        self.task_menu.add_command(label="⏹️ 取消", command=lambda: self.apply_to_selected("cancel_task"))
+        self.task_menu.add_separator()
+        self.task_menu.add_command(label="⏫ 下一个下载", command=lambda: self.apply_to_selected("download_next"))
+        self.task_menu.add_command(label="🔼 提高优先级", command=lambda: self.change_priority(1))
+        self.task_menu.add_command(label="🔽 降低优先级", command=lambda: self.change_priority(-1))
+        self.task_tree.bind('<Button-3>', self.show_task_menu)
+        
         # ==================== 日志 ====================
         log_frame = ttk.LabelFrame(main_frame, text="📝 日志", padding="5")
         log_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -779,10 +3737,10 @@ class VideoDownloaderApp:
         
         self.log_text = tk.Text(log_frame, height=10, wrap=tk.WORD, font=('Consolas', 9),
                                bg='#1e1e1e', fg='#00ff00', insertbackground='#00ff00')
-        self.log_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
-        
         log_scroll = ttk.Scrollbar(log_frame, orient=tk.VERTICAL, command=self.log_text.yview)
         self.log_text.configure(yscrollcommand=log_scroll.set)
+        log_scroll.pack(side=tk.RIGHT, fill=tk.Y, pady=(5, 0))
+        self.log_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True, pady=(5, 0))
         
     def update_status_display(self):
         if self.ffmpeg_manager.is_available:
@@ -795,12 +3753,23 @@ class VideoDownloaderApp:
         else:
             self.proxy_indicator.config(text="[Proxy ○]", fg='#888888')
             
+    def on_ffmpeg_detected(self):
+        self.update_status_display()
+        if self.ffmpeg_manager.is_available:
+            self.log(f"🎬 FFmpeg: 已就绪 ✓ ({self.ffmpeg_manager.version or ''})")
+        else:
+            self.log(f"⚠️ FFmpeg: 未配置 (无法下载4K)")
+    
     def open_settings(self):
         SettingsWindow(self.root, self.config, self.ffmpeg_manager, self.on_settings_closed)
         
     def on_settings_closed(self):
         self.config.reload()
         self.ffmpeg_manager.detect_ffmpeg()
+        # 带宽上限对正在进行的下载立即生效
+        self.bandwidth.set_rate(self.config.get("bandwidth_limit_mb", 0) * 1024 * 1024,
+                                fair=self.config.get("bandwidth_fair", True))
+        self.logs.set_max_lines(max(100, int(self.config.get("log_max_lines", 5000))))
         self.update_status_display()
         self.log("✅ 设置已更新")
         
@@ -857,140 +3826,118 @@ class VideoDownloaderApp:
             self.config.set("download_path", path)
             
     def log(self, message):
-        ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-        clean_message = ansi_escape.sub('', str(message))
-        self.log_text.insert(tk.END, clean_message + "\n")
-        self.log_text.see(tk.END)
+        """写日志 - 任意线程可调用，界面定时器批量插入"""
+        self.logs.write(message)
+    
+    def flush_log(self):
+        lines = self.logs.drain()
+        if not lines:
+            return
+        # 用户往上翻看时不自动滚到底
+        at_bottom = self.log_text.yview()[1] >= 0.999
+        self.log_text.insert(tk.END, "\n".join(lines) + "\n")
+        excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - self.logs.max_lines
+        if excess > 0:
+            self.log_text.delete('1.0', f'{excess + 1}.0')
+        if at_bottom:
+            self.log_text.see(tk.END)
         
     def clear_log(self):
+        self.logs.clear()
         self.log_text.delete(1.0, tk.END)
         
-    def get_urls(self):
-        """获取所有URL"""
-        text = self.url_text.get(1.0, tk.END)
-        urls = []
-        for line in text.strip().split('\n'):
-            line = line.strip()
-            if line and (line.startswith('http') or line.startswith('www')):
-                if line.startswith('www'):
-                    line = 'https://' + line
-                urls.append(line)
-        return urls
+    def on_log(self, message):
+        self.log(message)
         
-    def get_ydl_opts(self, for_info_only=False):
-        """获取 yt-dlp 配置 - 完全修复最高画质下载"""
-        download_path = self.path_var.get()
-        download_type = self.download_type.get()
-        quality = self.quality_var.get()
+    def on_task_added(self, task):
+        # 工作线程里不碰 Tk，交给界面定时器插入
+        self.download_manager.progress.announce(task)
+    
+    def on_task_finished(self, task):
+        pass  # 界面定时器发现 ProgressBus 上有任务结束时检查是否全部完成
         
-        opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'ignoreerrors': True,
-            'nocheckcertificate': True,
-            'outtmpl': os.path.join(download_path, '%(title)s.%(ext)s'),
-            # 多线程下载分片
-            'concurrent_fragment_downloads': self.config.get("thread_count", 8),
-            # 🔑 关键：允许不安全的扩展名（某些高分辨率格式需要）
-            'allow_unplayable_formats': False,
+    def insert_task_row(self, task):
+        self.task_tree.insert('', tk.END, iid=id(task), 
+                             values=(task.title[:50], task.status, f"{task.progress:.1f}%", task_speed_text(task),
+                                     task.resolution))
+    
+    def add_to_running_batch(self, urls):
+        """下载进行中再点下载: 把新链接加入当前队列，不用等这一批结束"""
+        manager = self.download_manager
+        existing = {task.url for task in manager.tasks}
+        urls = [url for url in urls if url not in existing]
+        # 只处理这次新建的任务；展开播放列表的线程同时加入的子任务由 on_task_added 插入
+        added, skipped = manager.add_urls(urls)
+        for task in added:
+            self.insert_task_row(task)
+        self.log(f"➕ 已加入 {len(added)} 个链接到当前下载"
+                 f"{f' (跳过 {skipped} 个已下载)' if skipped else ''}")
+    
+    def show_task_menu(self, event):
+        row = self.task_tree.identify_row(event.y)
+        if not row or not self.download_manager:
+            return
+        if row not in self.task_tree.selection():
+            self.task_tree.selection_set(row)
+        self.task_menu.tk_popup(event.x_root, event.y_root)
+    
+    def apply_to_selected(self, action):
+        """对选中的任务执行 DownloadManager 的 pause_task / resume_task / cancel_task"""
+        if not self.download_manager:
+            return
+        selected = set(self.task_tree.selection())
+        for task in self.download_manager.tasks:
+            if str(id(task)) in selected:
+                getattr(self.download_manager, action)(task)
+    
+    def change_priority(self, delta):
+        if not self.download_manager:
+            return
+        selected = set(self.task_tree.selection())
+        for task in self.download_manager.tasks:
+            if str(id(task)) in selected:
+                self.download_manager.set_priority(task, task.priority + delta)
+    
+    def toggle_pause(self):
+        if not self.download_manager:
+            return
+        if self.batch_paused:
+            count = self.download_manager.resume_all()
+            self.batch_paused = False
+            self.pause_btn.config(text="⏸️ 暂停全部")
+            self.log(f"▶️ 继续下载 {count} 个任务")
+        else:
+            count = self.download_manager.pause_all()
+            self.batch_paused = True
+            self.pause_btn.config(text="▶️ 继续全部")
+            self.log(f"⏸️ 已暂停 {count} 个任务 (已下载部分保留，继续时接着下载)")
+    
+    def get_urls(self):
+        """获取所有URL"""
+        return parse_urls(self.url_text.get(1.0, tk.END))
+    
+    def get_download_options(self):
+        """收集界面上的下载选项"""
+        return {
+            "download_path": self.path_var.get(),
+            "download_type": self.download_type.get(),
+            "quality": self.quality_var.get(),
+            "audio_format": self.audio_format.get(),
+            "audio_quality": self.audio_quality.get(),
+            "use_cookies": self.use_cookies.get(),
+            "use_proxy": self.use_proxy.get(),
+            "download_playlist": self.download_playlist.get(),
+            "embed_subs": self.embed_subs.get(),
+            "keep_original": self.keep_original.get(),
+            "container": self.container_var.get(),
+            "allow_transcode": self.allow_transcode.get(),
+            "audio_extra": self.audio_extra.get().strip(),
         }
         
-        # 播放列表设置
-        if not self.download_playlist.get():
-            opts['noplaylist'] = True
-        else:
-            opts['yes_playlist'] = True
-        
-        # Cookies - 4K视频通常需要
-        if self.use_cookies.get():
-            cookies_file = self.config.get("cookies_file", "")
-            cookies_browser = self.config.get("cookies_browser", "")
-            if cookies_file and os.path.exists(cookies_file):
-                opts['cookiefile'] = cookies_file
-            elif cookies_browser:
-                opts['cookiesfrombrowser'] = (cookies_browser,)
-                
-        # 代理
-        if self.use_proxy.get():
-            proxy = fix_proxy_protocol(self.config.get("proxy", ""))
-            if proxy:
-                opts['proxy'] = proxy
-                
-        # FFmpeg
-        ffmpeg_location = self.ffmpeg_manager.get_ffmpeg_location()
-        if ffmpeg_location:
-            opts['ffmpeg_location'] = ffmpeg_location
-            
-        # ========== 🔥 核心修复：格式选择 ==========
-        if download_type == "audio_only":
-            audio_fmt = self.audio_format.get()
-            audio_qual = self.audio_quality.get()
-            
-            # 选择最佳音频
-            opts['format'] = 'bestaudio/best'
-            opts['postprocessors'] = [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': audio_fmt,
-                'preferredquality': audio_qual if audio_qual != "0" else "0",
-            }]
-            
-        elif download_type == "video_only":
-            if quality == "best":
-                # 🔑 使用 bv* 获取所有视频格式中的最佳
-                opts['format'] = 'bv*[vcodec!^=none]/bv*/best'
-                # 强制按分辨率排序，最高优先
-                opts['format_sort'] = ['res:4320', 'res']  # 最高支持8K
-            else:
-                opts['format'] = f'bv*[height<={quality}]/bv*/best[height<={quality}]/best'
-                
-        else:  # video_audio - 最常用
-            if quality == "best":
-                # 🔑🔑🔑 关键修复：获取绝对最高画质
-                # bv* = 最佳视频（包括所有编码格式）
-                # ba = 最佳音频
-                # /b = 备选：合并格式
-                opts['format'] = 'bv*+ba/b'
-                
-                # 🔥 强制格式排序 - 分辨率最优先
-                opts['format_sort'] = [
-                    'res:4320',     # 优先8K
-                    'res:2160',     # 然后4K
-                    'res:1440',     # 然后2K
-                    'res',          # 然后按分辨率排序
-                    'vcodec:vp9.2', # VP9 Profile 2 (HDR)
-                    'vcodec:vp9',   # VP9
-                    'vcodec:av01',  # AV1
-                    'vcodec:avc',   # H.264
-                    'acodec:opus',  # Opus音频
-                    'acodec:aac',   # AAC音频
-                ]
-                
-                # 🔑 强制使用我们的排序规则
-                opts['format_sort_force'] = True
-                
-            else:
-                # 指定分辨率
-                opts['format'] = f'bv*[height<={quality}]+ba/b[height<={quality}]/b'
-                opts['format_sort'] = ['res', 'vcodec:vp9', 'acodec:opus']
-            
-            # 输出容器格式 - 不强制，让yt-dlp自动选择
-            if not self.keep_original.get():
-                # mkv 兼容性最好，支持几乎所有编码
-                opts['merge_output_format'] = 'mkv'
-                # 如果用户想要mp4，可能会限制某些编码
-                # opts['merge_output_format'] = 'mp4'
-            # else: 保持原始格式，不设置 merge_output_format
-            
-        # 字幕
-        if self.embed_subs.get():
-            opts['writesubtitles'] = True
-            opts['writeautomaticsub'] = True
-            opts['subtitleslangs'] = ['zh', 'en', 'zh-Hans', 'zh-Hant', 'ja', 'ko']
-            opts.setdefault('postprocessors', []).append({
-                'key': 'FFmpegEmbedSubtitle',
-            })
-            
-        return opts
+    def get_ydl_opts(self, for_info_only=False):
+        """获取 yt-dlp 配置"""
+        return build_ydl_opts(self.config, self.ffmpeg_manager, self.get_download_options(),
+                              for_info_only=for_info_only)
         
     def get_video_info(self):
         urls = self.get_urls()
@@ -1001,81 +3948,76 @@ class VideoDownloaderApp:
         threading.Thread(target=self._get_info, args=(urls,), daemon=True).start()
         
     def _get_info(self, urls):
+        prober = None
         try:
             opts = self.get_ydl_opts(for_info_only=True)
             opts['quiet'] = True
             
-            self.log(f"\n🔍 正在获取 {len(urls)} 个链接的信息...")
+            workers = max(1, int(self.config.get("probe_workers", 8)))
+            per_domain = max(1, int(self.config.get("probe_per_domain", 3)))
+            prober = self.prober = InfoProber(opts, max_workers=workers, per_domain=per_domain,
+                                              cache=self.info_cache)
+            self.root.after(0, lambda: self.cancel_btn.config(state='normal'))
             
-            for url in urls[:5]:  # 最多显示5个
-                try:
-                    with yt_dlp.YoutubeDL(opts) as ydl:
-                        info = ydl.extract_info(url, download=False)
-                        
-                        if info.get('_type') == 'playlist':
-                            entries = info.get('entries', [])
-                            self.log(f"\n📁 播放列表: {info.get('title', 'N/A')}")
-                            self.log(f"   视频数量: {len(entries)}")
-                        else:
-                            self.log("=" * 60)
-                            self.log(f"📹 标题: {info.get('title', 'N/A')}")
-                            self.log(f"⏱️ 时长: {self.format_duration(info.get('duration', 0))}")
-                            
-                            # 详细分析可用格式
-                            formats = info.get('formats', [])
-                            video_formats = [f for f in formats if f.get('vcodec') != 'none' and f.get('height')]
-                            
-                            if video_formats:
-                                # 按分辨率分组
-                                res_info = {}
-                                for f in video_formats:
-                                    h = f.get('height', 0)
-                                    vcodec = f.get('vcodec', 'unknown')
-                                    ext = f.get('ext', '?')
-                                    key = h
-                                    if key not in res_info:
-                                        res_info[key] = []
-                                    res_info[key].append(f"{vcodec[:10]}|{ext}")
-                                
-                                # 显示所有分辨率
-                                sorted_res = sorted(res_info.keys(), reverse=True)
-                                res_str = ', '.join([f'{r}p' for r in sorted_res[:8]])
-                                self.log(f"📺 可用画质: {res_str}")
-                                
-                                # 显示最高分辨率的详细信息
-                                max_res = sorted_res[0] if sorted_res else 0
-                                best_formats = [f for f in video_formats if f.get('height') == max_res]
-                                
-                                if best_formats:
-                                    # 找到最佳格式
-                                    best = max(best_formats, key=lambda x: (
-                                        x.get('filesize') or x.get('filesize_approx') or 0,
-                                        x.get('vbr') or 0
-                                    ))
-                                    
-                                    vcodec = best.get('vcodec', 'N/A')
-                                    ext = best.get('ext', 'N/A')
-                                    vbr = best.get('vbr', 0)
-                                    filesize = best.get('filesize') or best.get('filesize_approx') or 0
-                                    
-                                    size_str = f"{filesize/1024/1024:.1f}MB" if filesize else "未知"
-                                    vbr_str = f"{vbr:.0f}kbps" if vbr else "N/A"
-                                    
-                                    self.log(f"🏆 最高: {max_res}p | 编码: {vcodec} | 格式: {ext}")
-                                    self.log(f"   码率: {vbr_str} | 大小: {size_str}")
-                                    
-                                    # 显示其他高分辨率选项
-                                    for res in sorted_res[1:4]:
-                                        codecs = set([c.split('|')[0] for c in res_info[res]])
-                                        self.log(f"   {res}p: {', '.join(codecs)}")
-                                        
-                except Exception as e:
-                    self.log(f"❌ 获取失败: {str(e)[:100]}")
+            self.log(f"\n🔍 正在获取 {len(urls)} 个链接的信息 (并发 {workers}，每站点 {per_domain})...")
+            start_time = time.time()
+            
+            def on_result(url, summary, error):
+                if error:
+                    self.log(f"❌ 获取失败: {error[:100]}")
+                elif summary:
+                    self.log_video_info(summary)
                     
+            done = prober.probe(urls, on_result)
+            
             self.log("=" * 60)
+            if prober.cancelled:
+                self.log(f"⏹️ 已停止获取信息 ({done}/{len(urls)})")
+            else:
+                self.log(f"✅ 已获取 {done} 个链接的信息，用时 {time.time() - start_time:.1f} 秒")
+            if self.info_cache:
+                self.log(f"🗂️ 信息缓存: {self.info_cache.stats_text()}")
         finally:
-            self.root.after(0, lambda: self.info_btn.config(state='normal'))
+            if self.prober is prober:
+                self.prober = None
+            self.root.after(0, self._on_info_finished)
+    
+    def _on_info_finished(self):
+        self.info_btn.config(state='normal')
+        if not self.is_downloading:
+            self.cancel_btn.config(state='disabled')
+    
+    def log_video_info(self, summary):
+        """输出一个链接的格式信息 (VideoSummary)"""
+        if summary.is_playlist:
+            self.log(f"\n📁 播放列表: {summary.title or 'N/A'}")
+            self.log(f"   视频数量: {summary.entry_count}")
+        else:
+            self.log("=" * 60)
+            self.log(f"📹 标题: {summary.title or 'N/A'}")
+            self.log(f"⏱️ 时长: {self.format_duration(summary.duration or 0)}")
+            
+            if summary.heights:
+                self.log(f"📺 可用画质: {', '.join(f'{h}p' for h, _ in summary.heights)}")
+                
+                # 显示最高分辨率的详细信息
+                vcodec, ext, vbr, filesize = summary.best
+                size_str = f"{filesize/1024/1024:.1f}MB" if filesize else "未知"
+                vbr_str = f"{vbr:.0f}kbps" if vbr else "N/A"
+                self.log(f"🏆 最高: {summary.best_height}p | 编码: {vcodec or 'N/A'} | 格式: {ext or 'N/A'}")
+                self.log(f"   码率: {vbr_str} | 大小: {size_str}")
+                
+                # 显示其他高分辨率选项
+                for height, codecs in summary.heights[1:4]:
+                    self.log(f"   {height}p: {', '.join(codecs)}")
             
+            # 已选好格式 (如刚获取的信息) 时提前说明封装方式
+            options = self.get_download_options()
+            container = container_for(options)
+            if container and summary.selection:
+                plan, ext = plan_container(summary.selection, container, options["allow_transcode"])
+                self.log(f"📦 封装: {PLAN_LABELS[plan]} → {ext} ({summary.format_id})")
+    
     def format_duration(self, seconds):
         if not seconds:
             return "N/A"
@@ -1091,6 +4033,9 @@ class VideoDownloaderApp:
         if not urls:
             messagebox.showerror("错误", "请输入视频链接")
             return
+        if self.is_downloading and self.download_manager and self.download_manager.is_running:
+            self.add_to_running_batch(urls)
+            return
             
         quality = self.quality_var.get()
         if quality == "best" and not self.ffmpeg_manager.is_available:
@@ -1109,25 +4054,62 @@ class VideoDownloaderApp:
         for item in self.task_tree.get_children():
             self.task_tree.delete(item)
             
-        self.is_downloading = True
-        self.download_btn.config(state='disabled')
-        self.cancel_btn.config(state='normal')
-        
         # 创建下载管理器
         max_concurrent = self.config.get("max_concurrent", 3)
-        self.download_manager = DownloadManager(self, max_workers=max_concurrent)
+        if self.config.get("use_archive", False) and self.archive is None:
+            self.archive = open_download_archive(self.config)
+        archive = self.archive if self.config.get("use_archive", False) else None
+        concurrency = open_concurrency(self.config, self.on_log)
+        options = self.get_download_options()
+        try:
+            audio_outputs = audio_outputs_for(options) if options["download_type"] == "audio_only" else None
+        except ValueError as e:
+            messagebox.showerror("错误", f"音频输出设置有误: {e}")
+            return
+        missing = self.ffmpeg_manager.missing_encoders(audio_outputs)
+        if missing:
+            self.log(f"⚠️ 当前 FFmpeg 缺少编码器: {', '.join(missing)}，对应格式会转码失败")
+        if self.metrics:
+            self.metrics.close()
+        self.metrics = Metrics(self.config.get("trace_file") or None)
+        self.download_manager = DownloadManager(self, max_workers=max_concurrent,
+                                                job_store=self.job_store, archive=archive,
+                                                info_cache=self.info_cache, bandwidth=self.bandwidth,
+                                                concurrency=concurrency,
+                                                retry=retry_policy_from_config(self.config),
+                                                shortest_first=self.config.get("shortest_first", False),
+                                                postprocess_workers=self.config.get("postprocess_workers", 0),
+                                                container=container_for(options),
+                                                allow_transcode=options["allow_transcode"],
+                                                audio_outputs=audio_outputs,
+                                                ffmpeg=self.ffmpeg_manager.ffmpeg_path
+                                                if self.ffmpeg_manager.is_available else None,
+                                                metrics=self.metrics)
         
-        # 添加任务
-        for url in urls:
-            task = self.download_manager.add_task(url)
-            self.task_tree.insert('', tk.END, iid=id(task), 
-                                 values=(task.title[:50], task.status, f"{task.progress}%", task.speed, task.resolution))
+        # 添加任务 (已完成的链接跳过)
+        added, skipped = self.download_manager.add_urls(urls)
+        for task in added:
+            self.insert_task_row(task)
         
         self.log(f"\n{'='*60}")
-        self.log(f"🚀 开始下载 {len(urls)} 个链接")
+        if skipped:
+            self.log(f"⏭️ 跳过 {skipped} 个已下载的链接")
+        if not self.download_manager.tasks:
+            self.log("✅ 所有链接都已下载过，无需重复下载")
+            self.log(f"{'='*60}")
+            return
+        
+        self.is_downloading = True
+        self.batch_paused = False
+        self.download_btn.config(text="➕ 加入下载")
+        self.cancel_btn.config(state='normal')
+        self.pause_btn.config(state='normal', text="⏸️ 暂停全部")
+        
+        self.log(f"🚀 开始下载 {len(self.download_manager.tasks)} 个链接")
         self.log(f"📁 保存到: {self.path_var.get()}")
         self.log(f"📺 画质: {'原始最高' if quality == 'best' else quality + 'p'}")
-        self.log(f"⚡ 同时下载: {max_concurrent} | 线程: {self.config.get('thread_count', 8)}")
+        self.log(f"⚡ 同时下载: {max_concurrent} | 线程: {self.config.get('thread_count', 8)}"
+                 f"{' | 自适应' if concurrency else ''}")
         self.log(f"🎬 FFmpeg: {'✓' if self.ffmpeg_manager.is_available else '✗ (可能限制画质)'}")
         self.log(f"{'='*60}")
         
@@ -1141,44 +4123,67 @@ class VideoDownloaderApp:
         
         self.download_manager.start(ydl_opts)
         
+    def flush_progress(self):
+        """界面定时器 - 按 ui_refresh_hz 合并刷新任务列表"""
+        try:
+            if self.ffmpeg_manager.take_changed():
+                self.on_ffmpeg_detected()
+            self.flush_log()
+            self.update_task_display()
+        finally:
+            hz = max(1, int(self.config.get("ui_refresh_hz", 10)))
+            self.root.after(1000 // hz, self.flush_progress)
+    
     def update_task_display(self):
-        """更新任务列表显示"""
+        """更新任务列表显示 (只刷新有变化的行)"""
         if not self.download_manager:
             return
+        bus = self.download_manager.progress
+        for task in bus.drain_added():
+            try:
+                self.insert_task_row(task)
+            except tk.TclError:
+                pass  # 已经插入过
             
-        completed = 0
-        failed = 0
-        
-        for task in self.download_manager.tasks:
+        for task in bus.drain():
             try:
                 self.task_tree.item(id(task), values=(
                     task.title[:50] + "..." if len(task.title) > 50 else task.title,
                     task.status,
                     f"{task.progress:.1f}%",
-                    task.speed,
+                    task_speed_text(task),
                     task.resolution
                 ))
-                if task.completed:
-                    completed += 1
-                if task.error:
-                    failed += 1
-            except:
-                pass
+            except tk.TclError:
+                pass  # 行已被清除
                 
-        total = len(self.download_manager.tasks)
-        self.stats_label.config(text=f"完成: {completed}/{total} | 失败: {failed}")
+        if bus.stats_dirty or self.is_downloading:
+            bus.stats_dirty = False
+            batch_text = self.download_manager.batch_text()
+            self.stats_label.config(text=f"完成: {bus.completed}/{bus.total} | 失败: {bus.failed} | "
+                                         f"{self.bandwidth.status_text()} | "
+                                         f"{self.download_manager.stage_text()}"
+                                         + (f" | {batch_text}" if batch_text else ""))
+        if bus.take_finished():
+            self.check_all_completed()
         
     def check_all_completed(self):
         """检查是否全部完成"""
         if not self.download_manager:
             return
+        bus = self.download_manager.progress
+        if not self.is_downloading:
+            return  # 已取消或已汇总过
+        if self.download_manager.is_running and bus.done() < bus.total:
+            return
             
         all_done = all(task.completed or task.error or task.cancelled 
                       for task in self.download_manager.tasks)
         
         if all_done:
-            completed = sum(1 for t in self.download_manager.tasks if t.completed)
-            failed = sum(1 for t in self.download_manager.tasks if t.error)
+            self.update_task_display()
+            completed = bus.completed
+            failed = bus.failed
             
             # 统计分辨率
             resolutions = [t.resolution for t in self.download_manager.tasks if t.completed and t.resolution]
@@ -1187,12 +4192,38 @@ class VideoDownloaderApp:
             self.log(f"🎉 下载完成! 成功: {completed} | 失败: {failed}")
             if resolutions:
                 self.log(f"📺 下载画质: {', '.join(set(resolutions))}")
+            skipped = sum(1 for t in self.download_manager.tasks if t.skipped)
+            if skipped:
+                self.log(f"⏭️ 存档中已有，跳过: {skipped} 个")
+            extracts = sum(t.extract_count for t in self.download_manager.tasks)
+            started = sum(1 for t in self.download_manager.tasks if t.extract_count)
+            if started:
+                self.log(f"🔍 信息提取: {extracts} 次 (平均每任务 {extracts / started:.1f} 次)")
+            if self.info_cache:
+                self.log(f"🗂️ 信息缓存: {self.info_cache.stats_text()}")
+            self.log(f"🔌 {self.download_manager.sessions.stats_text()}")
+            retry_summary = self.download_manager.retry_summary()
+            if retry_summary:
+                self.log(f"🔁 错误分类: {retry_summary}")
+            plan_summary = self.download_manager.plan_summary()
+            if plan_summary:
+                self.log(f"📦 封装: {plan_summary}")
+            transcode_summary = self.download_manager.transcode_summary()
+            if transcode_summary:
+                self.log(f"🎵 转码: {transcode_summary}")
+            fragment_summary = self.download_manager.fragment_summary()
+            if fragment_summary:
+                self.log(f"🧩 分片: {fragment_summary}")
+            phase_summary = self.download_manager.metrics.summary()
+            if phase_summary:
+                self.log(f"⏱️ 阶段耗时: {phase_summary}")
             self.log(f"📁 保存在: {self.path_var.get()}")
             self.log(f"{'='*60}")
             
             self.is_downloading = False
-            self.download_btn.config(state='normal')
+            self.download_btn.config(state='normal', text="⬇️ 开始下载")
             self.cancel_btn.config(state='disabled')
+            self.pause_btn.config(state='disabled', text="⏸️ 暂停全部")
             
             if failed == 0:
                 messagebox.showinfo("完成", f"✅ 全部下载完成!\n\n成功: {completed} 个")
@@ -1200,16 +4231,277 @@ class VideoDownloaderApp:
                 messagebox.showwarning("完成", f"下载完成\n\n成功: {completed} 个\n失败: {failed} 个")
                 
     def cancel_download(self):
+        if self.prober:
+            self.prober.cancel()
         if self.download_manager:
             self.download_manager.cancel_all()
         self.is_downloading = False
-        self.download_btn.config(state='normal')
+        self.batch_paused = False
+        self.download_btn.config(state='normal', text="⬇️ 开始下载")
         self.cancel_btn.config(state='disabled')
-        self.log("\n⏹️ 已取消所有下载")
+        self.pause_btn.config(state='disabled', text="⏸️ 暂停全部")
+        self.log("\n⏹️ 已取消所有下载 (已下载部分保留，下次可继续)")
 
 
-def main():
+class HeadlessRunner(DownloadListener):
+    """无头模式 - 不依赖 tkinter，进度以 JSON 行输出到 stdout"""
+    
+    def __init__(self, options, max_concurrent=None, adaptive=None, max_retries=None, shortest_first=None,
+                 metrics_port=None, trace_file=None):
+        self.config = ConfigManager()
+        self.ffmpeg_manager = FFmpegManager(self.config)
+        self.job_store = open_job_store(self.config)
+        self.archive = open_download_archive(self.config) if self.config.get("use_archive", False) else None
+        self.info_cache = open_info_cache(self.config)
+        self.bandwidth = BandwidthScheduler(self.config.get("bandwidth_limit_mb", 0) * 1024 * 1024,
+                                            fair=self.config.get("bandwidth_fair", True))
+        self.options = options
+        self.max_concurrent = max_concurrent or self.config.get("max_concurrent", 3)
+        self.adaptive = adaptive
+        self.max_retries = max_retries
+        self.shortest_first = self.config.get("shortest_first", False) if shortest_first is None else shortest_first
+        self.pause_request = None  # 信号处理只记录请求，由主循环执行
+        self.download_manager = None
+        self.metrics = Metrics(trace_file or self.config.get("trace_file") or None)
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.print_lock = threading.Lock()
+    
+    def emit(self, event, **fields):
+        line = json.dumps({"event": event, "time": round(time.time(), 3), **fields}, ensure_ascii=False)
+        with self.print_lock:
+            print(line, flush=True)
+    
+    def task_fields(self, task):
+        return {
+            "url": task.url,
+            "title": task.title,
+            "status": task.status,
+            "progress": round(task.progress, 1),
+            "speed": task_speed_text(task),
+            "eta": format_eta(task.eta),
+            "downloaded_bytes": task.downloaded_bytes,
+            "total_bytes": task.total_bytes,
+            "bytes_per_sec": round(task.speed),
+            "eta_seconds": None if task.eta is None else round(task.eta, 1),
+            "resolution": task.resolution,
+        }
+    
+    def on_log(self, message):
+        self.emit("log", message=str(message))
+    
+    def on_task_added(self, task):
+        self.emit("added", parent=task.parent.url if task.parent else None, **self.task_fields(task))
+    
+    def on_task_finished(self, task):
+        self.emit("finished", ok=task.completed, archived=task.skipped, error=task.error,
+                  **self.task_fields(task))
+    
+    def flush_progress(self):
+        tasks = [t for t in self.download_manager.progress.drain() if not (t.completed or t.error)]
+        for task in tasks:
+            self.emit("progress", **self.task_fields(task))
+        if tasks:
+            manager = self.download_manager
+            batch = manager.batch_progress()
+            self.emit("throughput", bytes_per_sec=round(self.bandwidth.throughput()),
+                      limit=self.bandwidth.rate, stages=manager.stages.depths(manager.queued_count),
+                      batch_downloaded_bytes=batch["downloaded_bytes"], batch_total_bytes=batch["total_bytes"],
+                      batch_unknown=batch["unknown"],
+                      batch_eta_seconds=None if batch["eta"] is None else round(batch["eta"], 1))
+    
+    def apply_pause_request(self):
+        request, self.pause_request = self.pause_request, None
+        if request is True:
+            self.emit("paused", tasks=self.download_manager.pause_all())
+        elif request is False:
+            self.emit("resumed", tasks=self.download_manager.resume_all())
+    
+    def run(self, urls):
+        """下载全部链接，返回退出码 (0 全部成功 / 1 有失败 / 130 被中断)"""
+        concurrency = open_concurrency(self.config, self.on_log, self.adaptive)
+        if concurrency:
+            concurrency.start_tasks = min(self.max_concurrent, concurrency.max_tasks)
+        audio_outputs = audio_outputs_for(self.options) if self.options["download_type"] == "audio_only" else None
+        missing = self.ffmpeg_manager.missing_encoders(audio_outputs)
+        if missing:
+            self.on_log(f"⚠️ 当前 FFmpeg 缺少编码器: {', '.join(missing)}，对应格式会转码失败")
+        self.download_manager = DownloadManager(self, max_workers=self.max_concurrent,
+                                                job_store=self.job_store, archive=self.archive,
+                                                info_cache=self.info_cache, bandwidth=self.bandwidth,
+                                                concurrency=concurrency,
+                                                retry=retry_policy_from_config(self.config, self.max_retries),
+                                                shortest_first=self.shortest_first,
+                                                postprocess_workers=self.config.get("postprocess_workers", 0),
+                                                container=container_for(self.options),
+                                                allow_transcode=self.options["allow_transcode"],
+                                                audio_outputs=audio_outputs,
+                                                ffmpeg=self.ffmpeg_manager.ffmpeg_path
+                                                if self.ffmpeg_manager.is_available else None,
+                                                metrics=self.metrics)
+        if self.metrics_port is not None:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+                self.on_log(f"📊 指标: http://127.0.0.1:{self.metrics_server.port}/metrics")
+            except OSError as e:
+                self.on_log(f"⚠️ 指标端口 {self.metrics_port} 打开失败: {e}")
+        _, skipped = self.download_manager.add_urls(urls)
+        
+        ydl_opts = build_ydl_opts(self.config, self.ffmpeg_manager, self.options)
+        ydl_opts['noprogress'] = True  # 保持 stdout 只有 JSON 行
+        self.emit("start", total=len(self.download_manager.tasks), skipped=skipped,
+                  download_path=self.options["download_path"],
+                  max_concurrent=self.max_concurrent, thread_count=self.config.get("thread_count", 8),
+                  adaptive=concurrency is not None,
+                  ffmpeg=self.ffmpeg_manager.is_available, format=ydl_opts.get('format'))
+        self.download_manager.start(ydl_opts)
+        
+        bus = self.download_manager.progress
+        interval = 1 / max(1, int(self.config.get("ui_refresh_hz", 10)))
+        if hasattr(signal, 'SIGUSR1'):
+            # kill -USR1 暂停全部，kill -USR2 继续
+            signal.signal(signal.SIGUSR1, lambda *_: setattr(self, 'pause_request', True))
+            signal.signal(signal.SIGUSR2, lambda *_: setattr(self, 'pause_request', False))
+        try:
+            while bus.done() < bus.total:
+                time.sleep(interval)
+                self.apply_pause_request()
+                self.flush_progress()
+        except KeyboardInterrupt:
+            self.download_manager.cancel_all()
+            if self.job_store:
+                self.job_store.close()
+            self.close_metrics()
+            self.emit("cancelled", completed=bus.completed, failed=bus.failed, cancelled=bus.cancelled,
+                      total=bus.total)
+            return 130
+        
+        self.download_manager.shutdown()
+        if self.job_store:
+            self.job_store.close()
+        self.close_metrics()
+        extracts = sum(t.extract_count for t in self.download_manager.tasks)
+        self.emit("done", completed=bus.completed, failed=bus.failed, total=bus.total, extracts=extracts,
+                  cache_hits=self.info_cache.hits if self.info_cache else 0,
+                  cache_misses=self.info_cache.misses if self.info_cache else 0,
+                  sessions_created=self.download_manager.sessions.created,
+                  sessions_reused=self.download_manager.sessions.reused,
+                  errors=self.download_manager.error_counts, recovered=self.download_manager.recovered,
+                  plans=self.download_manager.plan_counts,
+                  transcoded=self.download_manager.transcoder.encoded if self.download_manager.transcoder else 0,
+                  copied=self.download_manager.transcoder.copied if self.download_manager.transcoder else 0,
+                  phases={phase: round(seconds, 3) for phase, seconds in self.metrics.phase_seconds.items()},
+                  bytes=self.metrics.bytes_total, fragments=self.metrics.fragments_total,
+                  fragments_reused=self.download_manager.fragment_counts['reused'],
+                  fragments_repaired=self.download_manager.fragment_counts['repaired'])
+        return 0 if bus.failed == 0 else 1
+    
+    def close_metrics(self):
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        self.metrics.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="多平台视频下载器")
+    parser.add_argument('--headless', action='store_true', help='无界面模式，进度以 JSON 行输出')
+    parser.add_argument('url_file', nargs='?', help='链接文件，一行一个 ("-" 表示标准输入)')
+    parser.add_argument('--resume', action='store_true', help='继续任务库中上次未完成的任务')
+    parser.add_argument('-o', '--output', help='保存目录 (默认使用配置中的 download_path)')
+    parser.add_argument('--type', dest='download_type', choices=['video_audio', 'video_only', 'audio_only'])
+    parser.add_argument('--quality', choices=['best', '4320', '2160', '1440', '1080', '720', '480'])
+    parser.add_argument('--audio-format', help='音频格式，可用逗号分隔多个 (如 mp3,opus)，'
+                        f'支持 {"/".join(AudioTranscoder.ENCODERS)}')
+    parser.add_argument('--audio-quality', help='音频码率 kbps，0 为最高，可用逗号分隔多个 (如 320,128)')
+    parser.add_argument('--no-cookies', action='store_true', help='不使用 Cookies')
+    parser.add_argument('--no-proxy', action='store_true', help='不使用代理')
+    parser.add_argument('--no-playlist', action='store_true', help='不下载播放列表')
+    parser.add_argument('--embed-subs', action='store_true', help='嵌入字幕')
+    parser.add_argument('--keep-original', action='store_true', help='保持原始格式')
+    parser.add_argument('--container', choices=['mkv', 'mp4', 'webm'], help='合并输出容器 (默认 mkv)')
+    parser.add_argument('--allow-transcode', action='store_true',
+                        help='所选编码放不进目标容器时允许转码 (默认换用 mkv，不转码)')
+    parser.add_argument('-j', '--concurrent', type=int, help='同时下载数 (默认使用配置中的 max_concurrent)')
+    parser.add_argument('--adaptive', action='store_true', default=None,
+                        help='自适应并发，按站点吞吐自动调整同时下载数和分片线程数')
+    parser.add_argument('--shortest-first', action='store_true', default=None,
+                        help='同优先级时按缓存信息中的文件大小，小文件先下载')
+    parser.add_argument('--retries', type=int, help='临时错误的重试次数 (默认使用配置中的 max_retries)')
+    parser.add_argument('--limit-rate', type=float, metavar='MB/S', help='总带宽上限 (默认使用配置中的 bandwidth_limit_mb)')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='无界面模式下在 127.0.0.1:PORT/metrics 提供 Prometheus 指标 (0 为随机端口)')
+    parser.add_argument('--trace', metavar='FILE', help='每次下载尝试的阶段耗时追加写入 JSONL 文件')
+    parser.add_argument('--profile-startup', action='store_true', help='输出启动各阶段和 yt-dlp 导入的耗时明细 (stderr)')
+    args = parser.parse_args(argv)
+    if args.headless and not args.url_file and not args.resume:
+        parser.error("--headless 需要指定链接文件或 --resume")
+    try:
+        AudioTranscoder.parse_outputs(args.audio_format or "mp3", args.audio_quality or "0")
+    except ValueError as e:
+        parser.error(str(e))
+    return args
+
+
+def options_from_args(args, config):
+    """由命令行参数和配置生成下载选项"""
+    options = dict(DEFAULT_DOWNLOAD_OPTIONS)
+    options["download_path"] = args.output or config.get("download_path")
+    for key in ("download_type", "quality", "audio_format", "audio_quality"):
+        if getattr(args, key):
+            options[key] = getattr(args, key)
+    if args.no_cookies:
+        options["use_cookies"] = False
+    if args.no_proxy:
+        options["use_proxy"] = False
+    if args.no_playlist:
+        options["download_playlist"] = False
+    options["embed_subs"] = args.embed_subs
+    options["keep_original"] = args.keep_original
+    if args.container:
+        options["container"] = args.container
+    options["allow_transcode"] = args.allow_transcode
+    return options
+
+
+def run_headless(args):
+    # 读配置、检测 FFmpeg、打开任务库的同时在后台导入 yt-dlp
+    preload_yt_dlp()
+    text = ""
+    if args.url_file == '-':
+        text = sys.stdin.read()
+    elif args.url_file:
+        with open(args.url_file, 'r', encoding='utf-8') as f:
+            text = f.read()
+    options = options_from_args(args, ConfigManager())
+    runner = HeadlessRunner(options, max_concurrent=args.concurrent, adaptive=args.adaptive,
+                            max_retries=args.retries, shortest_first=args.shortest_first,
+                            metrics_port=args.metrics_port, trace_file=args.trace)
+    if args.limit_rate is not None:
+        runner.bandwidth.set_rate(args.limit_rate * 1024 * 1024)
+    urls = parse_urls(text)
+    if args.resume and runner.job_store:
+        urls = list(dict.fromkeys(runner.job_store.unfinished() + urls))
+    if not urls:
+        print("没有找到有效链接", file=sys.stderr)
+        return 2
+    startup.mark("初始化 (配置/FFmpeg/任务库)")
+    if startup.enabled:
+        yt_dlp.load()
+        startup.report()
+    return runner.run(urls)
+
+
+def main(argv=None):
+    startup.mark("模块初始化")
+    args = parse_args(argv)
+    startup.enabled = args.profile_startup
+    if args.headless:
+        return run_headless(args)
+    
+    load_tkinter()
     root = tk.Tk()
+    startup.mark("创建 Tk 根窗口")
     
     if is_admin():
         if not messagebox.askyesno("警告", 
@@ -1218,8 +4510,15 @@ def main():
             return
     
     app = VideoDownloaderApp(root)
+    startup.mark("创建主界面")
+    
+    def on_interactive():
+        startup.mark("窗口可交互")
+        # yt-dlp 在窗口显示后再加载，加载完输出启动耗时
+        preload_yt_dlp(startup.report)
+    root.after_idle(on_interactive)
     root.mainloop()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())